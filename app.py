@@ -1,9 +1,15 @@
+import json
+import os
 
 from starlette.applications import Starlette
-from starlette.responses import PlainTextResponse
+from starlette.responses import JSONResponse, PlainTextResponse
 import uvicorn
 
-from graphql import build_schema, extend_schema, parse, graphql_sync
+from graphql import build_schema, extend_schema, format_error, graphql, parse
+
+from connection import connection_sdl, paginate
+from dataloader import Loaders
+from datasource import RESTDatasource
 
 ROOT_QUERY = """
   type Query {
@@ -30,6 +36,34 @@ EXTENDED = """
   }
 """
 
+COMPUTE = """
+  type ComputeFlavor {
+    id: String!
+    name: String
+    ram: Int
+    vcpus: Int
+    disk: Int
+  }
+
+  type ComputeServer {
+    id: String!
+    name: String
+    status: String
+    region: String
+    flavor: ComputeFlavor
+  }
+
+  extend type Query {
+    computeServers(region: String, filters: String): [ComputeServer]
+    computeServersConnection(
+      region: String
+      filters: String
+      first: Int
+      after: String
+    ): ComputeServerConnection
+  }
+"""
+
 ACTIONS = """
   type ComputeServerAction {
     name: String!
@@ -68,33 +102,76 @@ schema = build_schema(
   ROOT_QUERY
 )
 schema = extend_schema(schema, parse(EXTENDED))
-
-query = """
-{
-  hello(name: "frank") {
-    name
-    last
-  }
-}
-"""
+schema = extend_schema(schema, parse(COMPUTE + connection_sdl(['ComputeServer'])))
 
 
 class Resource:
-    pass
+    """A REST resource from the service catalog (ie compute servers).
+
+    The class attributes describe where to find the resource and how long
+    responses are cached, `datasource.RESTDatasource` does the fetching.
+    """
+    catalog_type: str = None
+    root: str = None
+    # Responses are fresh for `cache_ttl` seconds, then served stale for up
+    # to `stale_ttl` seconds while they are refreshed in the background.
+    cache_ttl: float = 30
+    stale_ttl: float = 300
+
+    def __init__(self, data: dict, region: str = None):
+        self.data = data
+        self.region = region
+
+    def __getattr__(self, name):
+        # Fall back to the attributes of the api response, methods with the
+        # same name as an attribute (ie ComputeServer.flavor) take priority.
+        try:
+            return self.__dict__['data'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+def parse_filters(filters: str = None) -> list:
+    """Parse 'attr:value,attr:value' into a list of (attr, value) tuples."""
+    if not filters:
+        return []
+    filter_list = []
+    for filter_string in filters.split(','):
+        attribute, sep, value = filter_string.partition(':')
+        if not sep:
+            raise ValueError(f'Invalid filter {filter_string!r}, expected attr:value')
+        filter_list.append((attribute, value))
+    return filter_list
 
-class Filter:
-    def __init__(self, filter_string: str):
-        self.attribute, self.value = filter_string.split(':')
-    def matches(self, server):
-        return getattr(server, self.attibute, None) == self.value
 
 async def computeServers(_source, info, region='ALL', filters=None):
     # If we were lucky there would be a query arg for the server list api
     # never fear we can do this logic here and make it performant with caching.
-    servers = await info.context.ComputeServer.list(region)
-    filter_list = [Filter(f) for f in filters.split(',')]
-    return list(filter(filter_list.matches, servers))  # prolly doesn't work :)
+    # The cached server list keeps an index for each attribute we filter on,
+    # so the filters are ANDed together by intersecting the index buckets.
+    return await info.context.ComputeServer.filter(region, parse_filters(filters))
+
 
+async def computeServersConnection(
+    _source,
+    info,
+    region='ALL',
+    filters=None,
+    first=None,
+    after=None,
+):
+    # Same as `computeServers` but only a page of the servers ends up in the
+    # response rather than every server in every region.
+    servers = await computeServers(_source, info, region=region, filters=filters)
+    return paginate(servers, first=first, after=after)
+
+
+
+class ComputeFlavor(Resource):
+    catalog_type = 'compute'
+    root = 'flavors'
+    # Flavors hardly ever change so they can be cached for much longer.
+    cache_ttl = 60 * 60
 
 
 class ComputeServer(Resource):
@@ -102,11 +179,27 @@ class ComputeServer(Resource):
     root = 'servers'
 
     async def flavor(self, info):
-        # we use a list call because we memoize/cache the api calls
-        flavors = await info.context.ComputeFlavor.list(self.region)
-        for flavor in flavors:
-            if flavor.id == self.flavor['id']:
-                return flavor
+        # Every server in the list asks for its flavor in the same tick, the
+        # loader turns that into a single flavor list call per region.
+        loader = info.context.loaders['ComputeFlavor']
+        return await loader.load((self.region, self.data['flavor']['id']))
+
+
+# The service catalog of {catalog_type: {region: endpoint}}, normally this
+# is returned by the identity service along with the auth token.
+SERVICE_CATALOG = json.loads(os.environ.get('SERVICE_CATALOG', '{}'))
+
+
+class Context:
+    """Request scoped context passed to the resolvers as `info.context`."""
+    resources = [ComputeServer, ComputeFlavor]
+
+    def __init__(self, request, catalog=None):
+        self.request = request
+        self.catalog = catalog or SERVICE_CATALOG
+        for resource in self.resources:
+            setattr(self, resource.__name__, RESTDatasource(resource, self))
+        self.loaders = Loaders(self)
 
 
 class User:
@@ -125,6 +218,8 @@ def hello(source, info, name):
 registry = {
   'Query': {
     'hello': hello,
+    'computeServers': computeServers,
+    'computeServersConnection': computeServersConnection,
   },
   'User': {
     'laste': lambda _source, _info, **kwarg: 'frank'
@@ -139,23 +234,13 @@ def resolver(resource, info, **kwargs):
         res = registry[name][info.field_name]
     except KeyError:
         attr = getattr(resource, info.field_name, None)
-        if attr:
-            if callable(attr):
-                return attr(info, **kwargs)
-            return attr
+        if callable(attr):
+            return attr(info, **kwargs)
+        return attr
 
     return res(resource, info, **kwargs)
 
 
-results = graphql_sync(
-    schema,
-    query,
-    field_resolver=resolver
-)
-
-print(results)
-
-
 app = Starlette()
 app.debug = True
 
@@ -165,7 +250,30 @@ def homepage(request):
     return PlainTextResponse('text')
 
 
+@app.route('/graphql', methods=['POST'])
+async def graphql_endpoint(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return JSONResponse({'errors': [{'message': 'Unable to parse JSON'}]}, 400)
+
+    # The async executor awaits coroutine resolvers like `computeServers` and
+    # `ComputeServer.flavor` concurrently on the event loop. The context is
+    # created per request so the resource clients and loaders are not shared.
+    results = await graphql(
+        schema,
+        data.get('query'),
+        context_value=Context(request),
+        variable_values=data.get('variables'),
+        operation_name=data.get('operationName'),
+        field_resolver=resolver,
+    )
+
+    response = {'data': results.data}
+    if results.errors:
+        response['errors'] = [format_error(error) for error in results.errors]
+    return JSONResponse(response)
+
+
 if __name__ == '__main__':
-    print('done')
-    assert uvicorn
-    # uvicorn.run(app, http='h11', host='0.0.0.0', port=16000)
+    uvicorn.run(app, http='h11', host='0.0.0.0', port=16000)
@@ -0,0 +1,90 @@
+import base64
+from typing import Any, List, NamedTuple, Optional
+
+# Relay style connections for list fields. Rather than writing the edge and
+# connection types out by hand for every type, `connection_sdl` generates
+# them for the type names it is given.
+PAGE_INFO_SDL = """
+  type PageInfo {
+    hasNextPage: Boolean!
+    endCursor: String
+  }
+"""
+
+CONNECTION_SDL = """
+  type {name}Edge {{
+    cursor: String!
+    node: {name}
+  }}
+
+  type {name}Connection {{
+    edges: [{name}Edge]
+    pageInfo: PageInfo!
+  }}
+"""
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def connection_sdl(type_names: List[str]) -> str:
+    return PAGE_INFO_SDL + ''.join(
+        CONNECTION_SDL.format(name=type_name) for type_name in type_names
+    )
+
+
+class Edge(NamedTuple):
+    node: Any
+    cursor: str
+
+
+class PageInfo(NamedTuple):
+    hasNextPage: bool
+    endCursor: Optional[str]
+
+
+class Connection(NamedTuple):
+    edges: List[Edge]
+    pageInfo: PageInfo
+
+
+def encode_cursor(position: int) -> str:
+    return base64.urlsafe_b64encode(f'position:{position}'.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        prefix, _, position = base64.urlsafe_b64decode(cursor).decode().partition(':')
+        if prefix != 'position':
+            raise ValueError
+        position = int(position)
+        if position < 0:
+            raise ValueError
+        return position
+    except ValueError:
+        raise ValueError('Invalid cursor')
+
+
+def page_size(first: Optional[int]) -> int:
+    if first is None:
+        return DEFAULT_PAGE_SIZE
+    if first < 0:
+        raise ValueError('first must not be negative')
+    return min(first, MAX_PAGE_SIZE)
+
+
+def paginate(items: list, first: int = None, after: str = None) -> Connection:
+    """Return a page of an in memory list as a Connection.
+
+    The lists we page through are already cached in memory, so the cursor is
+    just the position in the list and building a page is a slice.
+    """
+    size = page_size(first)
+    start = decode_cursor(after) + 1 if after is not None else 0
+    page = items[start:start + size]
+    edges = [
+        Edge(node, encode_cursor(position))
+        for position, node in enumerate(page, start)
+    ]
+    end_cursor = edges[-1].cursor if edges else None
+    return Connection(edges, PageInfo(start + size < len(items), end_cursor))
@@ -0,0 +1,124 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+BatchLoadFn = Callable[[List[Hashable]], Awaitable[List[Any]]]
+
+
+class DataLoader:
+    """Coalesce individual `load(key)` calls into a single batch call.
+
+    Resolvers for a list of objects all run in the same tick of the event
+    loop. Rather than each one calling the backend, they ask the loader for
+    a key and the loader calls `batch_load_fn` once with every key that was
+    requested in that tick. Results are memoized for the life of the loader,
+    which is a single request, so asking for the same key twice is free.
+
+    The `batch_load_fn` is a coroutine that accepts a list of keys and
+    returns a list of values in the same order. A value may be an Exception
+    instance in which case only that key fails.
+    """
+
+    def __init__(
+        self,
+        batch_load_fn: BatchLoadFn,
+        max_batch_size: Optional[int] = None,
+    ):
+        self.batch_load_fn = batch_load_fn
+        self.max_batch_size = max_batch_size
+        self._cache: Dict[Hashable, asyncio.Future] = {}
+        self._queue: List[tuple] = []
+        self.loads = 0
+        self.cache_hits = 0
+        self.batches = 0
+        self.keys_loaded = 0
+
+    def load(self, key: Hashable) -> Awaitable[Any]:
+        self.loads += 1
+        future = self._cache.get(key)
+        if future is not None:
+            self.cache_hits += 1
+            return future
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._cache[key] = future
+        self._queue.append((key, future))
+        if len(self._queue) == 1:
+            # Wait for every other resolver in this tick to queue its key.
+            loop.call_soon(self._dispatch)
+        return future
+
+    async def load_many(self, keys: List[Hashable]) -> List[Any]:
+        return await asyncio.gather(*[self.load(key) for key in keys])
+
+    def prime(self, key: Hashable, value: Any):
+        """Add a value to the cache, useful when a list call returns it."""
+        if key not in self._cache:
+            future = asyncio.get_event_loop().create_future()
+            future.set_result(value)
+            self._cache[key] = future
+
+    def clear(self, key: Hashable):
+        self._cache.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'loads': self.loads,
+            'cache_hits': self.cache_hits,
+            'batches': self.batches,
+            'keys_loaded': self.keys_loaded,
+        }
+
+    def _dispatch(self):
+        queue, self._queue = self._queue, []
+        size = self.max_batch_size or len(queue)
+        for start in range(0, len(queue), size):
+            asyncio.ensure_future(self._load_batch(queue[start:start + size]))
+
+    async def _load_batch(self, batch: List[tuple]):
+        keys = [key for key, _future in batch]
+        self.batches += 1
+        self.keys_loaded += len(keys)
+        try:
+            values = await self.batch_load_fn(keys)
+            if len(values) != len(keys):
+                raise ValueError(
+                    f'batch_load_fn returned {len(values)} values '
+                    f'for {len(keys)} keys'
+                )
+        except Exception as error:
+            for key, future in batch:
+                # Do not memoize failures, the next request can try again.
+                self._cache.pop(key, None)
+                future.set_exception(error)
+            return
+
+        for (key, future), value in zip(batch, values):
+            if isinstance(value, Exception):
+                self._cache.pop(key, None)
+                future.set_exception(value)
+            else:
+                future.set_result(value)
+
+
+class Loaders:
+    """Request scoped loaders, one for each resource type.
+
+    Loaders are looked up by the name of the resource client on the context,
+    ie `info.context.loaders['ComputeFlavor']` batches calls through
+    `info.context.ComputeFlavor.batch_load`.
+    """
+
+    def __init__(self, context: Any):
+        self.context = context
+        self._loaders: Dict[str, DataLoader] = {}
+
+    def __getitem__(self, resource_name: str) -> DataLoader:
+        loader = self._loaders.get(resource_name)
+        if loader is None:
+            resource = getattr(self.context, resource_name)
+            loader = self._loaders[resource_name] = DataLoader(resource.batch_load)
+        return loader
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {name: loader.stats() for name, loader in self._loaders.items()}
@@ -0,0 +1,386 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+
+class UpstreamError(Exception):
+    """The upstream api returned an error status."""
+
+    def __init__(self, status: int, url: str):
+        super().__init__(f'{url} returned {status}')
+        self.status = status
+        self.url = url
+
+
+class UpstreamTimeout(asyncio.TimeoutError):
+    """The upstream api did not connect or respond in time."""
+
+    def __init__(self, host: str, timeout: float):
+        super().__init__(f'{host} did not respond within {timeout}s')
+        self.host = host
+        self.timeout = timeout
+
+
+class ConnectionPool:
+    """Keep-alive HTTP/1.1 connections to a single upstream host.
+
+    Opening a new connection (and TLS handshake) for every api call is most of
+    the cost of talking to the catalog services. The pool keeps idle
+    connections around for the next request and limits the number of
+    requests in flight so a slow upstream is not buried by our fan out.
+    Connecting and each response are limited to `timeout` seconds, so a
+    stalled upstream can not hold on to a slot forever.
+    """
+
+    def __init__(
+        self,
+        scheme: str,
+        host: str,
+        port: int,
+        max_connections: int = 10,
+        timeout: float = 10,
+    ):
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._idle: List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = []
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop = None
+
+    def _bind_loop(self):
+        # Connections and semaphores belong to an event loop, if the loop has
+        # changed (ie in tests) start over with a fresh pool.
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._idle = []
+            self._semaphore = asyncio.Semaphore(self.max_connections)
+
+    def close(self):
+        """Close the idle connections, requests in flight finish as usual."""
+        idle, self._idle = self._idle, []
+        for _reader, writer in idle:
+            writer.close()
+
+    async def _connect(self):
+        try:
+            return await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=self.scheme == 'https'),
+                self.timeout,
+            )
+        except asyncio.TimeoutError:
+            raise UpstreamTimeout(self.host, self.timeout)
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        headers: Dict[str, str] = None,
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        self._bind_loop()
+        async with self._semaphore:
+            # An idle connection may have been closed by the server, in that
+            # case try once more on a brand new connection.
+            for reused in (True, False):
+                if reused and self._idle:
+                    reader, writer = self._idle.pop()
+                else:
+                    reused = False
+                    reader, writer = await self._connect()
+                try:
+                    status, response_headers, body, keep_alive = await asyncio.wait_for(
+                        self._send(reader, writer, method, path, headers or {}),
+                        self.timeout,
+                    )
+                except asyncio.TimeoutError:
+                    # The connection is in an unknown state, never reuse it.
+                    writer.close()
+                    raise UpstreamTimeout(self.host, self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused:
+                        continue
+                    raise
+                except Exception:
+                    writer.close()
+                    raise
+                if keep_alive:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+                return status, response_headers, body
+
+    async def _send(self, reader, writer, method, path, headers):
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}:{self.port}']
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        lines.append('Connection: keep-alive')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionError('Connection closed by upstream')
+        version, status, *_reason = status_line.decode('latin-1').split(None, 2)
+
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+
+        keep_alive = (
+            version == 'HTTP/1.1'
+            and response_headers.get('connection', '').lower() != 'close'
+        )
+        if response_headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # Skip over any trailers to the end of the response.
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                body += await reader.readexactly(size)
+                await reader.readexactly(2)
+            body = bytes(body)
+        elif 'content-length' in response_headers:
+            body = await reader.readexactly(int(response_headers['content-length']))
+        else:
+            # No framing, the body runs until the connection is closed.
+            body = await reader.read()
+            keep_alive = False
+        return int(status), response_headers, body, keep_alive
+
+
+# Pools are shared by every request, one for each upstream endpoint.
+_pools: Dict[Tuple[str, str, int], ConnectionPool] = {}
+
+
+def get_pool(url: str, max_connections: int = 10, timeout: float = 10) -> ConnectionPool:
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    key = (parts.scheme, parts.hostname, port)
+    pool = _pools.get(key)
+    if pool is None:
+        pool = _pools[key] = ConnectionPool(
+            parts.scheme, parts.hostname, port, max_connections, timeout)
+    return pool
+
+
+class TTLCache:
+    """Cross request cache of api responses with stale-while-revalidate.
+
+    Entries are fresh for `ttl` seconds. For `stale_ttl` seconds after that
+    the stale value is still returned right away while a single background
+    task refreshes it, so only cold keys ever make a request wait.
+    """
+
+    def __init__(self, max_entries: int = 1000):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[Any, Tuple[Any, float, float]]' = OrderedDict()
+        self._inflight: Dict[Any, asyncio.Future] = {}
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.clock = time.monotonic
+
+    def clear(self):
+        self._entries.clear()
+
+    async def get(self, key, fetch, ttl: float, stale_ttl: float = 0):
+        entry = self._entries.get(key)
+        now = self.clock()
+        if entry is not None:
+            value, fresh_until, stale_until = entry
+            self._entries.move_to_end(key)
+            if now < fresh_until:
+                self.hits += 1
+                return value
+            if now < stale_until:
+                self.stale_hits += 1
+                if key not in self._inflight:
+                    self._fetch(key, fetch, ttl, stale_ttl)
+                return value
+
+        self.misses += 1
+        # Concurrent requests for a cold key share the same upstream call.
+        future = self._inflight.get(key) or self._fetch(key, fetch, ttl, stale_ttl)
+        return await asyncio.shield(future)
+
+    def _fetch(self, key, fetch, ttl, stale_ttl) -> asyncio.Future:
+        async def refresh():
+            try:
+                value = await fetch()
+                now = self.clock()
+                self._entries[key] = (value, now + ttl, now + ttl + stale_ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                return value
+            finally:
+                self._inflight.pop(key, None)
+
+        future = self._inflight[key] = asyncio.ensure_future(refresh())
+        # Background refreshes may fail without anyone awaiting them.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return future
+
+
+# Shared by every request, keyed by the auth token hash and url.
+response_cache = TTLCache()
+
+
+class ResourceList:
+    """The records from a list call with hash indexes on their attributes.
+
+    A ResourceList is what gets stored in the `response_cache`, so each index
+    is built at most once per cache refresh and then shared by every request
+    that filters on that attribute. Filtering on several attributes is an
+    intersection of the index buckets rather than a scan of every record.
+    """
+
+    def __init__(self, items: list):
+        self.items = items
+        self._indexes: Dict[str, Dict[str, set]] = {}
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def index(self, attribute: str) -> Dict[str, set]:
+        index = self._indexes.get(attribute)
+        if index is None:
+            index = {}
+            for position, item in enumerate(self.items):
+                value = item.data.get(attribute)
+                # Filters are strings, so only scalar values can match them.
+                if value is None or isinstance(value, (dict, list)):
+                    continue
+                index.setdefault(str(value), set()).add(position)
+            self._indexes[attribute] = index
+        return index
+
+    def filter(self, filters: List[Tuple[str, str]]) -> list:
+        """Return the items matching every (attribute, value) filter."""
+        if not filters:
+            return list(self.items)
+        buckets = [self.index(attribute).get(value, set()) for attribute, value in filters]
+        # Start from the smallest bucket so the intersection stays small.
+        buckets.sort(key=len)
+        positions = buckets[0]
+        for bucket in buckets[1:]:
+            positions = positions & bucket
+            if not positions:
+                break
+        return [self.items[position] for position in sorted(positions)]
+
+
+class RESTDatasource:
+    """Request scoped access to a REST resource from the service catalog.
+
+    The `resource` class describes the api (`catalog_type`, `root`, cache
+    ttls) and wraps each item from the response. Identical GETs during a
+    request are memoized, responses are shared between requests through the
+    `response_cache` and connections are pooled per upstream endpoint.
+    """
+    max_connections = 10
+    # Seconds to wait for an upstream to connect and then to respond.
+    timeout = float(os.environ.get('UPSTREAM_TIMEOUT', 10))
+
+    def __init__(self, resource, context):
+        self.resource = resource
+        self.context = context
+        self._memo: Dict[str, asyncio.Future] = {}
+
+    @property
+    def auth_token(self) -> Optional[str]:
+        return self.context.request.headers.get('x-auth-token')
+
+    def endpoint(self, region: str) -> str:
+        return self.context.catalog[self.resource.catalog_type][region]
+
+    def regions(self, region: str) -> List[str]:
+        if region == 'ALL':
+            return list(self.context.catalog[self.resource.catalog_type])
+        return [region]
+
+    def get(self, url: str, parse: Callable[[Any], Any] = None) -> asyncio.Future:
+        """GET and decode the JSON response, once per url per request.
+
+        The optional `parse` function is applied to the decoded JSON before
+        it is cached, so the work it does is shared across requests.
+        """
+        future = self._memo.get(url)
+        if future is None:
+            future = self._memo[url] = asyncio.ensure_future(self._cached_get(url, parse))
+        return future
+
+    async def _cached_get(self, url: str, parse: Callable[[Any], Any] = None) -> Any:
+        token = self.auth_token
+        # Never share cached responses between users.
+        token_hash = hashlib.sha256(token.encode()).hexdigest() if token else None
+        return await response_cache.get(
+            (token_hash, url),
+            lambda: self._fetch(url, token, parse),
+            ttl=self.resource.cache_ttl,
+            stale_ttl=self.resource.stale_ttl,
+        )
+
+    async def _fetch(
+        self,
+        url: str,
+        token: Optional[str],
+        parse: Callable[[Any], Any] = None,
+    ) -> Any:
+        parts = urlsplit(url)
+        path = parts.path + (f'?{parts.query}' if parts.query else '')
+        headers = {'Accept': 'application/json'}
+        if token:
+            headers['X-Auth-Token'] = token
+        pool = get_pool(url, self.max_connections, self.timeout)
+        status, _headers, body = await pool.request('GET', path, headers)
+        if status >= 400:
+            raise UpstreamError(status, url)
+        data = json.loads(body)
+        return parse(data) if parse else data
+
+    def list_region(self, region: str) -> asyncio.Future:
+        """The ResourceList for a single region."""
+        def parse(data):
+            return ResourceList([
+                self.resource(item, region) for item in data[self.resource.root]
+            ])
+        url = f'{self.endpoint(region)}/{self.resource.root}/detail'
+        return self.get(url, parse=parse)
+
+    async def list(self, region: str) -> list:
+        return await self.filter(region, [])
+
+    async def filter(self, region: str, filters: List[Tuple[str, str]]) -> list:
+        """List the resources in the region matching all of the filters."""
+        listings = await asyncio.gather(*[
+            self.list_region(name) for name in self.regions(region)
+        ])
+        return [item for listing in listings for item in listing.filter(filters)]
+
+    async def batch_load(self, keys: list) -> list:
+        """Load many (region, id) keys with a single list call per region."""
+        regions = list({region for region, _id in keys})
+        listings = await asyncio.gather(*[self.list(region) for region in regions])
+        by_key = {}
+        for region, items in zip(regions, listings):
+            for item in items:
+                by_key[(region, item.id)] = item
+        return [by_key.get(key) for key in keys]
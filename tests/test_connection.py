@@ -0,0 +1,76 @@
+import base64
+import unittest
+
+from connection import MAX_PAGE_SIZE, connection_sdl, decode_cursor, encode_cursor, paginate
+
+
+def cursor(text):
+    return base64.urlsafe_b64encode(text.encode()).decode()
+
+
+class PaginateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.items = list(range(7))
+
+    def nodes(self, connection):
+        return [edge.node for edge in connection.edges]
+
+    def test_pages_follow_the_end_cursor(self):
+        pages = []
+        after = None
+        while True:
+            connection = paginate(self.items, first=3, after=after)
+            pages.append(self.nodes(connection))
+            if not connection.pageInfo.hasNextPage:
+                break
+            after = connection.pageInfo.endCursor
+
+        self.assertEqual(pages, [[0, 1, 2], [3, 4, 5], [6]])
+
+    def test_exact_last_page_has_no_next_page(self):
+        connection = paginate(self.items, first=7)
+
+        self.assertEqual(self.nodes(connection), self.items)
+        self.assertFalse(connection.pageInfo.hasNextPage)
+
+    def test_past_the_end_is_an_empty_page(self):
+        connection = paginate(self.items, first=3, after=encode_cursor(6))
+
+        self.assertEqual(connection.edges, [])
+        self.assertIsNone(connection.pageInfo.endCursor)
+        self.assertFalse(connection.pageInfo.hasNextPage)
+
+    def test_page_size_is_capped(self):
+        connection = paginate(list(range(MAX_PAGE_SIZE * 2)), first=MAX_PAGE_SIZE * 2)
+
+        self.assertEqual(len(connection.edges), MAX_PAGE_SIZE)
+        self.assertTrue(connection.pageInfo.hasNextPage)
+
+    def test_negative_first_is_rejected(self):
+        with self.assertRaises(ValueError):
+            paginate(self.items, first=-1)
+
+    def test_bad_cursors_are_rejected(self):
+        for after in (
+            'not base64!',
+            'abc',
+            cursor('offset:3'),
+            cursor('position:'),
+            cursor('position:three'),
+            cursor('position:-3'),
+            base64.urlsafe_b64encode(b'\xff\xfe').decode(),
+        ):
+            with self.subTest(after=after):
+                with self.assertRaisesRegex(ValueError, 'Invalid cursor'):
+                    paginate(self.items, after=after)
+
+    def test_cursor_round_trip(self):
+        self.assertEqual(decode_cursor(encode_cursor(42)), 42)
+
+    def test_connection_sdl(self):
+        sdl = connection_sdl(['ComputeServer'])
+
+        self.assertIn('type ComputeServerConnection {', sdl)
+        self.assertIn('node: ComputeServer', sdl)
+        self.assertEqual(sdl.count('type PageInfo'), 1)
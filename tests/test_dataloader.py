@@ -0,0 +1,100 @@
+import asyncio
+import unittest
+
+from dataloader import DataLoader, Loaders
+
+
+class FakeClient:
+    """A resource client that records the keys of every batch."""
+
+    def __init__(self, missing=()):
+        self.batches = []
+        self.missing = set(missing)
+
+    async def batch_load(self, keys):
+        self.batches.append(list(keys))
+        return [
+            KeyError(key) if key in self.missing else {'id': key[1], 'region': key[0]}
+            for key in keys
+        ]
+
+
+class DataLoaderTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_loads_in_the_same_tick_are_batched(self):
+        client = FakeClient()
+        loader = DataLoader(client.batch_load)
+
+        actual = await asyncio.gather(*[
+            loader.load(('ORD', flavor)) for flavor in ('1', '2', '1', '3')
+        ])
+
+        self.assertEqual([flavor['id'] for flavor in actual], ['1', '2', '1', '3'])
+        self.assertEqual(client.batches, [[('ORD', '1'), ('ORD', '2'), ('ORD', '3')]])
+        self.assertEqual(
+            loader.stats(),
+            {'loads': 4, 'cache_hits': 1, 'batches': 1, 'keys_loaded': 3},
+        )
+
+    async def test_results_are_memoized(self):
+        client = FakeClient()
+        loader = DataLoader(client.batch_load)
+
+        first = await loader.load(('ORD', '1'))
+        second = await loader.load(('ORD', '1'))
+
+        self.assertIs(first, second)
+        self.assertEqual(len(client.batches), 1)
+
+    async def test_max_batch_size_splits_batches(self):
+        client = FakeClient()
+        loader = DataLoader(client.batch_load, max_batch_size=2)
+
+        await loader.load_many([('ORD', str(flavor)) for flavor in range(5)])
+
+        self.assertEqual([len(batch) for batch in client.batches], [2, 2, 1])
+
+    async def test_errors_only_fail_their_key_and_are_not_memoized(self):
+        client = FakeClient(missing={('ORD', '2')})
+        loader = DataLoader(client.batch_load)
+
+        found, missing = await asyncio.gather(
+            loader.load(('ORD', '1')),
+            loader.load(('ORD', '2')),
+            return_exceptions=True,
+        )
+
+        self.assertEqual(found['id'], '1')
+        self.assertIsInstance(missing, KeyError)
+
+        client.missing.clear()
+        self.assertEqual((await loader.load(('ORD', '2')))['id'], '2')
+        self.assertEqual(len(client.batches), 2)
+
+    async def test_wrong_number_of_values_fails_the_batch(self):
+        async def batch_load(keys):
+            return []
+
+        loader = DataLoader(batch_load)
+
+        with self.assertRaises(ValueError):
+            await loader.load('key')
+
+
+class LoadersTest(unittest.IsolatedAsyncioTestCase):
+
+    async def test_one_loader_per_resource_client(self):
+        class Context:
+            ComputeFlavor = FakeClient()
+
+        context = Context()
+        loaders = Loaders(context)
+
+        self.assertIs(loaders['ComputeFlavor'], loaders['ComputeFlavor'])
+
+        # Every server resolving its flavor turns into one batch.
+        await asyncio.gather(*[
+            loaders['ComputeFlavor'].load((region, '1')) for region in ('ORD', 'DFW')
+        ])
+        self.assertEqual(context.ComputeFlavor.batches, [[('ORD', '1'), ('DFW', '1')]])
+        self.assertEqual(loaders.stats()['ComputeFlavor']['batches'], 1)
@@ -0,0 +1,279 @@
+import asyncio
+import json
+import unittest
+from unittest import mock
+
+import datasource
+
+
+class StubServer:
+    """A local upstream api that serves JSON and counts what it is asked.
+
+    Responses are `{"path": ..., "flavors": [...]}` unless the path is in
+    `statuses`. Every response waits `delay` seconds, and when `stall` is
+    set the server reads the request and never answers.
+    """
+
+    def __init__(self):
+        self.connections = 0
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.delay = 0
+        self.stall = False
+        self.statuses = {}
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}'
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                _method, path, _version = request_line.decode('latin-1').split()
+                self.requests.append((path, headers.get('x-auth-token')))
+
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                try:
+                    if self.stall:
+                        await asyncio.sleep(3600)
+                    await asyncio.sleep(self.delay)
+                finally:
+                    self.in_flight -= 1
+
+                status = self.statuses.get(path, 200)
+                body = json.dumps({
+                    'path': path,
+                    'flavors': [{'id': '1', 'ram': 512}, {'id': '2', 'ram': 1024}],
+                }).encode()
+                writer.write(
+                    f'HTTP/1.1 {status} OK\r\n'
+                    f'Content-Type: application/json\r\n'
+                    f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+class Flavor:
+    catalog_type = 'compute'
+    root = 'flavors'
+    cache_ttl = 30
+    stale_ttl = 300
+
+    def __init__(self, data, region=None):
+        self.data = data
+        self.region = region
+
+    @property
+    def id(self):
+        return self.data['id']
+
+
+class Request:
+
+    def __init__(self, token='token'):
+        self.headers = {'x-auth-token': token}
+
+
+class Context:
+
+    def __init__(self, url, token='token'):
+        self.request = Request(token)
+        self.catalog = {'compute': {'ORD': f'{url}/ord', 'DFW': f'{url}/dfw'}}
+
+
+class StubServerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        datasource.response_cache.clear()
+        self.upstream = StubServer()
+        await self.upstream.start()
+
+    async def asyncTearDown(self):
+        for pool in datasource._pools.values():
+            pool.close()
+        datasource._pools.clear()
+        await self.upstream.stop()
+
+
+class ConnectionPoolTest(StubServerTest):
+
+    async def test_connections_are_reused(self):
+        pool = datasource.ConnectionPool('http', '127.0.0.1', self.port())
+        self.addCleanup(pool.close)
+
+        for path in ('/one', '/two', '/three'):
+            status, _headers, body = await pool.request('GET', path)
+            self.assertEqual(status, 200)
+            self.assertEqual(json.loads(body)['path'], path)
+
+        self.assertEqual(self.upstream.connections, 1)
+        self.assertEqual(len(self.upstream.requests), 3)
+
+    async def test_in_flight_requests_are_limited(self):
+        pool = datasource.ConnectionPool('http', '127.0.0.1', self.port(), max_connections=2)
+        self.addCleanup(pool.close)
+        self.upstream.delay = 0.05
+
+        responses = await asyncio.gather(*[
+            pool.request('GET', f'/{number}') for number in range(6)
+        ])
+
+        self.assertEqual([status for status, _h, _b in responses], [200] * 6)
+        self.assertEqual(self.upstream.max_in_flight, 2)
+        self.assertEqual(self.upstream.connections, 2)
+
+    async def test_stalled_upstream_times_out_and_frees_the_slot(self):
+        pool = datasource.ConnectionPool(
+            'http', '127.0.0.1', self.port(), max_connections=1, timeout=0.1)
+        self.addCleanup(pool.close)
+        self.upstream.stall = True
+
+        with self.assertRaises(datasource.UpstreamTimeout):
+            await pool.request('GET', '/stalled')
+
+        self.upstream.stall = False
+        status, _headers, _body = await pool.request('GET', '/next')
+        self.assertEqual(status, 200)
+
+    async def test_connect_times_out(self):
+        pool = datasource.ConnectionPool('http', '127.0.0.1', self.port(), timeout=0.1)
+
+        async def connect(*args, **kwargs):
+            await asyncio.sleep(3600)
+
+        with mock.patch('asyncio.open_connection', connect):
+            with self.assertRaises(datasource.UpstreamTimeout):
+                await pool.request('GET', '/slow')
+
+    def port(self):
+        return int(self.upstream.url.rsplit(':', 1)[1])
+
+
+class RESTDatasourceTest(StubServerTest):
+
+    async def test_gets_are_memoized_for_the_request(self):
+        client = datasource.RESTDatasource(Flavor, Context(self.upstream.url))
+
+        first, second = await asyncio.gather(
+            client.list('ORD'),
+            client.list('ORD'),
+        )
+
+        self.assertEqual([flavor.id for flavor in first], ['1', '2'])
+        self.assertEqual([flavor.id for flavor in second], ['1', '2'])
+        self.assertEqual(self.upstream.requests, [('/ord/flavors/detail', 'token')])
+
+    async def test_responses_are_shared_between_requests_of_a_user(self):
+        for token in ('token', 'token', 'other'):
+            client = datasource.RESTDatasource(Flavor, Context(self.upstream.url, token))
+            await client.list('ALL')
+
+        self.assertEqual(sorted(self.upstream.requests), [
+            ('/dfw/flavors/detail', 'other'),
+            ('/dfw/flavors/detail', 'token'),
+            ('/ord/flavors/detail', 'other'),
+            ('/ord/flavors/detail', 'token'),
+        ])
+
+    async def test_batch_load_lists_each_region_once(self):
+        client = datasource.RESTDatasource(Flavor, Context(self.upstream.url))
+
+        actual = await client.batch_load([('ORD', '2'), ('DFW', '1'), ('ORD', '1'), ('ORD', '9')])
+
+        self.assertEqual(
+            [(flavor.region, flavor.id) if flavor else None for flavor in actual],
+            [('ORD', '2'), ('DFW', '1'), ('ORD', '1'), None],
+        )
+        self.assertEqual(len(self.upstream.requests), 2)
+
+    async def test_error_status_raises(self):
+        self.upstream.statuses['/ord/flavors/detail'] = 503
+        client = datasource.RESTDatasource(Flavor, Context(self.upstream.url))
+
+        with self.assertRaises(datasource.UpstreamError) as raised:
+            await client.list('ORD')
+
+        self.assertEqual(raised.exception.status, 503)
+
+
+class TTLCacheTest(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.now = 1000.0
+        self.cache = datasource.TTLCache()
+        self.cache.clock = lambda: self.now
+        self.fetches = 0
+
+    async def fetch(self):
+        self.fetches += 1
+        await asyncio.sleep(0)
+        return self.fetches
+
+    async def get(self):
+        return await self.cache.get('key', self.fetch, ttl=10, stale_ttl=20)
+
+    async def test_fresh_entries_are_hits(self):
+        self.assertEqual(await self.get(), 1)
+        self.now += 9
+
+        self.assertEqual(await self.get(), 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    async def test_stale_entries_are_served_while_refreshing(self):
+        await self.get()
+        self.now += 15
+
+        # Both callers get the stale value right away, and only one refresh
+        # goes upstream in the background.
+        self.assertEqual(await self.get(), 1)
+        self.assertEqual(await self.get(), 1)
+        await asyncio.sleep(0.01)
+
+        self.assertEqual(self.fetches, 2)
+        self.assertEqual(self.cache.stale_hits, 2)
+        self.assertEqual(await self.get(), 2)
+
+    async def test_expired_entries_wait_for_a_fetch(self):
+        await self.get()
+        self.now += 31
+
+        self.assertEqual(await self.get(), 2)
+        self.assertEqual(self.cache.misses, 2)
+
+    async def test_concurrent_misses_share_one_fetch(self):
+        actual = await asyncio.gather(*[self.get() for _ in range(5)])
+
+        self.assertEqual(actual, [1] * 5)
+        self.assertEqual(self.fetches, 1)
+
+    async def test_failed_fetches_are_not_cached(self):
+        async def fail():
+            raise datasource.UpstreamError(500, 'http://upstream')
+
+        with self.assertRaises(datasource.UpstreamError):
+            await self.cache.get('key', fail, ttl=10)
+
+        self.assertEqual(await self.get(), 1)
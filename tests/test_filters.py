@@ -0,0 +1,76 @@
+import unittest
+
+from datasource import ResourceList
+
+
+class Server:
+
+    def __init__(self, **data):
+        self.data = data
+
+
+def servers():
+    return ResourceList([
+        Server(id='1', status='ACTIVE', name='web', flavor={'id': '2'}),
+        Server(id='2', status='ACTIVE', name='db', flavor={'id': '3'}),
+        Server(id='3', status='ERROR', name='web', flavor={'id': '2'}),
+        Server(id='4', status='ACTIVE', name='web', progress=100),
+        Server(id='5', status=None, name='worker'),
+    ])
+
+
+def ids(items):
+    return [item.data['id'] for item in items]
+
+
+class ResourceListFilterTest(unittest.TestCase):
+
+    def test_no_filters_returns_everything(self):
+        self.assertEqual(ids(servers().filter([])), ['1', '2', '3', '4', '5'])
+
+    def test_single_filter(self):
+        self.assertEqual(ids(servers().filter([('status', 'ACTIVE')])), ['1', '2', '4'])
+
+    def test_filters_are_anded_in_list_order(self):
+        actual = servers().filter([('name', 'web'), ('status', 'ACTIVE')])
+
+        self.assertEqual(ids(actual), ['1', '4'])
+
+    def test_unknown_value_matches_nothing(self):
+        self.assertEqual(servers().filter([('status', 'DELETED')]), [])
+
+    def test_empty_bucket_short_circuits_the_other_filters(self):
+        actual = servers().filter([
+            ('status', 'ACTIVE'),
+            ('name', 'missing'),
+            ('name', 'web'),
+        ])
+
+        self.assertEqual(actual, [])
+
+    def test_unknown_attribute_matches_nothing(self):
+        self.assertEqual(servers().filter([('color', 'blue'), ('status', 'ACTIVE')]), [])
+
+    def test_disjoint_filters_match_nothing(self):
+        self.assertEqual(servers().filter([('name', 'db'), ('status', 'ERROR')]), [])
+
+    def test_values_are_compared_as_strings(self):
+        self.assertEqual(ids(servers().filter([('progress', '100')])), ['4'])
+
+    def test_none_and_nested_values_are_not_indexed(self):
+        listing = servers()
+
+        self.assertEqual(listing.filter([('status', 'None')]), [])
+        self.assertEqual(listing.filter([('flavor', "{'id': '2'}")]), [])
+        self.assertNotIn('None', listing.index('status'))
+
+    def test_indexes_are_built_once(self):
+        listing = servers()
+
+        self.assertIs(listing.index('status'), listing.index('status'))
+
+    def test_repeated_filter_on_the_same_attribute(self):
+        listing = servers()
+
+        self.assertEqual(ids(listing.filter([('name', 'web'), ('name', 'web')])), ['1', '3', '4'])
+        self.assertEqual(listing.filter([('name', 'web'), ('name', 'db')]), [])
@@ -120,3 +120,22 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static_root')
+
+
+# Identity service
+# Verified tokens are cached for at most PREF_TOKEN_CACHE_TTL seconds (or
+# until they expire) and rejected tokens for PREF_TOKEN_NEGATIVE_TTL seconds.
+
+PREF_IDENTITY_TIMEOUT = 5
+PREF_TOKEN_CACHE_TTL = 300
+PREF_TOKEN_NEGATIVE_TTL = 30
+
+# Identity user ids, by site url, of the services allowed to read the data of
+# every user of the site, ie `{'https://example.com': ['notifications']}`.
+
+PREF_SERVICE_USERS = {}
+
+# Function used to encode api responses, `pref.store.encoders.orjson_dumps`
+# is much faster if orjson is installed.
+
+PREF_JSON_ENCODER = 'pref.store.encoders.json_dumps'
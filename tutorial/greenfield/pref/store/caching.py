@@ -0,0 +1,156 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+
+from django.core.cache import cache
+
+
+def initial_version() -> int:
+    # Start new counters from the clock rather than zero. If the version key
+    # is ever evicted the new counter is still ahead of any version that
+    # was handed out before.
+    return time.time_ns() // 1000
+
+
+def get_version(version_key: str) -> int:
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, initial_version(), None)
+        version = cache.get(version_key)
+    return version
+
+
+def get_versions(*version_keys: str) -> Tuple[int, ...]:
+    """Get many versions with a single round trip when they all exist."""
+    versions = cache.get_many(version_keys)
+    missing = [key for key in version_keys if key not in versions]
+    if missing:
+        versions.update(init_versions(missing))
+    return tuple(versions[key] for key in version_keys)
+
+
+def init_versions(version_keys: List[str]) -> Dict[str, int]:
+    """Create many versions that a `get_many` just found missing.
+
+    Like `reset_versions` every key starts from one clock reading, which is
+    ahead of any counter handed out before, so a key another worker created
+    in the meantime is only moved forward. One `set_many` and one `get_many`
+    replace a `get_version` per key.
+    """
+    version = initial_version()
+    cache.set_many({key: version for key in version_keys}, None)
+    versions = cache.get_many(version_keys)
+    for key in version_keys:
+        if key not in versions:
+            # Evicted already, fall back to creating it on its own.
+            versions[key] = get_version(key)
+    return versions
+
+
+def bump_version(version_key: str) -> int:
+    """Atomically increment the version stored at `version_key`."""
+    try:
+        return cache.incr(version_key)
+    except ValueError:
+        cache.add(version_key, initial_version(), None)
+        return cache.incr(version_key)
+
+
+def reset_versions(version_keys: List[str]):
+    """Move many versions forward at once, ie after a bulk import.
+
+    A fresh clock based version is ahead of any counter that started from
+    an earlier clock reading, so one `set_many` replaces an `incr` per key.
+    """
+    version = initial_version()
+    cache.set_many({key: version for key in version_keys}, None)
+
+
+class LocalCache:
+    """In process LRU cache in front of the django cache.
+
+    Entries are served without any network I/O for `ttl` seconds. After that
+    the version key is checked and the entry is kept if the version has not
+    changed, otherwise it is loaded again. Bumping the version invalidates
+    the entry in every worker within `ttl` seconds.
+
+    Callers that already read the version, ie to stamp something built from
+    the entry, pass it as `version`. The entry is then only used if it was
+    loaded under that version, otherwise it is loaded again right away.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 10):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[Hashable, Tuple[Any, int, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._entries
+
+    def get(
+        self,
+        key: Hashable,
+        version_key: str,
+        load: Callable[[], Any],
+        version: int = None,
+    ) -> Any:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                value, entry_version, expires = entry
+                if entry_version == version or (version is None and now < expires):
+                    self.hits += 1
+                    return value
+
+        if version is None:
+            # Read the version before loading, a change made while we load
+            # leaves the entry with an outdated version.
+            current = get_version(version_key)
+            if entry is not None and entry_version == current:
+                self.revalidations += 1
+                with self._lock:
+                    self._entries[key] = (value, entry_version, now + self.ttl)
+                return value
+        else:
+            current = version
+
+        self.misses += 1
+        value = load()
+        with self._lock:
+            newer = self._entries.get(key)
+            if newer is not None and newer[1] > current:
+                # The caller read an older version, keep the newer entry.
+                return value
+            self._entries[key] = (value, current, now + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def discard(self, *keys: Hashable):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'revalidations': self.revalidations,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'max_size': self.max_entries,
+        }
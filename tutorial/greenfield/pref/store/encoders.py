@@ -0,0 +1,29 @@
+"""JSON encoders for the api responses.
+
+The encoder is picked with the `PREF_JSON_ENCODER` setting, which is the
+dotted path to a function that takes a JSON serializable object and returns
+bytes. `json_dumps` only needs the standard library, `orjson_dumps` is a lot
+faster but needs `pip install orjson`.
+"""
+import json
+from typing import Any, Callable
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+def json_dumps(value: Any) -> bytes:
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def orjson_dumps(value: Any) -> bytes:
+    import orjson
+    return orjson.dumps(value)
+
+
+def get_encoder() -> Callable[[Any], bytes]:
+    return import_string(getattr(settings, 'PREF_JSON_ENCODER', 'pref.store.encoders.json_dumps'))
+
+
+def dumps(value: Any) -> bytes:
+    return get_encoder()(value)
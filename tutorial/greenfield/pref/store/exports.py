@@ -0,0 +1,42 @@
+"""Stream every override of a site as newline delimited JSON.
+
+The rows come from a server side cursor with `iterator(chunk_size=...)` and
+are written out one line at a time, so memory use does not depend on the
+size of the site. Rows are ordered by the override uuid, which is also the
+`cursor` of each line. Pass the last cursor seen as `after` to resume an
+export that was interrupted.
+"""
+import uuid
+from typing import Iterator, Optional
+
+from . import encoders
+from .kinds import KINDS
+from .models import Override, SiteController
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+def iter_overrides(
+    site_url: str,
+    after: Optional[uuid.UUID] = None,
+    chunk_size: int = EXPORT_CHUNK_SIZE,
+) -> Iterator[bytes]:
+    # Make sure the site exists before we start streaming a response.
+    SiteController.get(site_url=site_url)
+    rows = Override.objects.filter(site__pk=site_url)
+    if after is not None:
+        rows = rows.filter(uuid__gt=after)
+    rows = rows.order_by('uuid').values_list('uuid', 'user_id', 'key', 'kind', 'value')
+    return _lines(rows.iterator(chunk_size=chunk_size))
+
+
+def _lines(rows) -> Iterator[bytes]:
+    dumps = encoders.get_encoder()
+    for override_uuid, user_id, key, kind, value in rows:
+        yield dumps({
+            'cursor': str(override_uuid),
+            'user_id': user_id,
+            'key': key,
+            'kind': kind,
+            'value': KINDS[kind].deserialize(value),
+        }) + b'\n'
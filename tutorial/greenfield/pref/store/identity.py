@@ -0,0 +1,137 @@
+"""Verify auth tokens against the identity service of a site.
+
+The token is sent to the site's `auth_url` in the `X-Auth-Token` header. The
+service responds with `{"user_id": "...", "expires_at": "<iso 8601>"}` for a
+valid token, `expires_at` is optional. A 401, 403 or 404 means the token was
+rejected, anything else is an error with the identity service itself.
+"""
+import hashlib
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import Future
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidToken(Exception):
+    pass
+
+
+class IdentityError(Exception):
+    """The identity service could not verify the token."""
+
+
+def verify_token(auth_url: str, token: str) -> Tuple[str, Optional[float]]:
+    """Ask the identity service for the user id and expiration of the token."""
+    request = urllib.request.Request(auth_url, headers={
+        'Accept': 'application/json',
+        'X-Auth-Token': token,
+    })
+    timeout = getattr(settings, 'PREF_IDENTITY_TIMEOUT', 5)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            data = json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        if error.code in (401, 403, 404):
+            raise InvalidToken
+        raise IdentityError(f'{auth_url} returned {error.code}')
+    except (OSError, ValueError) as error:
+        raise IdentityError(f'{auth_url} failed: {error}')
+
+    if not isinstance(data, dict) or not data.get('user_id'):
+        raise IdentityError(f'{auth_url} did not return a user_id')
+
+    expires_at = None
+    if data.get('expires_at'):
+        expires = parse_datetime(data['expires_at'])
+        if expires is None:
+            raise IdentityError(f'{auth_url} returned an invalid expires_at')
+        expires_at = expires.timestamp()
+    return str(data['user_id']), expires_at
+
+
+class TokenCache:
+    """Cache of verified tokens so only the first request calls the identity service.
+
+    Tokens are stored as a sha256 hash of the auth url and token, a dump of
+    the cache does not leak credentials. Valid tokens are cached until they
+    expire or for `ttl` seconds whichever is sooner. Rejected tokens are
+    cached for `negative_ttl` seconds so a bad client can not hammer the
+    identity service. Concurrent requests in this process for a token that is
+    not cached wait for a single call to the identity service.
+    """
+
+    # Stored for rejected tokens, a user id is never empty.
+    REJECTED = ''
+
+    def __init__(self, ttl: int = 300, negative_ttl: int = 30):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.calls = 0
+        self._inflight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def cache_key(self, auth_url: str, token: str) -> str:
+        digest = hashlib.sha256(f'{auth_url}\n{token}'.encode('utf-8')).hexdigest()
+        return f'token:{digest}'
+
+    def get_user_id(self, auth_url: str, token: str) -> str:
+        if not token:
+            raise InvalidToken
+        _cache_key = self.cache_key(auth_url, token)
+        user_id = cache.get(_cache_key)
+        if user_id is None:
+            user_id = self._verify_once(_cache_key, auth_url, token)
+        if user_id == self.REJECTED:
+            raise InvalidToken
+        return user_id
+
+    def _verify_once(self, _cache_key: str, auth_url: str, token: str) -> str:
+        with self._lock:
+            future = self._inflight.get(_cache_key)
+            leader = future is None
+            if leader:
+                future = self._inflight[_cache_key] = Future()
+        if not leader:
+            return future.result()
+
+        try:
+            user_id = self._verify(_cache_key, auth_url, token)
+        except Exception as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(user_id)
+        finally:
+            with self._lock:
+                self._inflight.pop(_cache_key, None)
+        return user_id
+
+    def _verify(self, _cache_key: str, auth_url: str, token: str) -> str:
+        self.calls += 1
+        try:
+            user_id, expires_at = verify_token(auth_url, token)
+        except InvalidToken:
+            cache.set(_cache_key, self.REJECTED, self.negative_ttl)
+            return self.REJECTED
+
+        ttl = self.ttl
+        if expires_at is not None:
+            ttl = min(ttl, int(expires_at - time.time()))
+        # Do not cache a token past its expiration, the identity service
+        # will have to reject it next time.
+        if ttl > 0:
+            cache.set(_cache_key, user_id, ttl)
+        return user_id
+
+
+token_cache = TokenCache(
+    ttl=getattr(settings, 'PREF_TOKEN_CACHE_TTL', 300),
+    negative_ttl=getattr(settings, 'PREF_TOKEN_NEGATIVE_TTL', 30),
+)
@@ -0,0 +1,314 @@
+"""Bulk import of Kinds and Overrides for onboarding a site.
+
+Rows are read one at a time from CSV or newline delimited JSON and handled
+in batches. Each batch is validated with a single lookup of the site
+defaults, grouped by kind so each `KINDS` serializer is applied to all of
+its values in one pass, and then written in its own transaction with bulk
+queries. The cached preferences of the users in a batch are invalidated in
+bulk once it commits.
+"""
+import csv
+import json
+import time
+from itertools import islice
+from typing import IO, Any, Dict, Iterable, Iterator, List, NamedTuple, Tuple, Union
+
+from django.core.cache import cache
+from django.db import transaction
+
+from .kinds import KINDS, KindController
+from .models import Change, Kind, Override, PreferenceController, SiteController
+
+IMPORT_BATCH_SIZE = 1000
+
+# Only the first few invalid rows are kept, the rest are only counted.
+MAX_ERRORS = 100
+
+# The spellings accepted for a BOOLEAN. Reads take anything else as false,
+# an import rejects it so typos are reported instead of stored.
+BOOLEANS = {'1': True, 'on': True, 'true': True, '0': False, 'off': False, 'false': False}
+
+
+def parse_boolean(value: Any) -> bool:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in BOOLEANS:
+        return BOOLEANS[value.lower()]
+    raise ValueError(f'Invalid boolean {value!r}')
+
+
+# The serializers used to check imported values, stricter than `KINDS`.
+IMPORT_KINDS: Dict[str, KindController] = dict(
+    KINDS,
+    BOOLEAN=KindController(lambda value: str(parse_boolean(value)), parse_boolean),
+)
+
+
+class InvalidRow(NamedTuple):
+    """Takes the place of a row that could not be read."""
+    message: str
+
+
+Row = Union[Dict[str, Any], InvalidRow]
+
+
+class ImportReport:
+    """Counts and timing of an import."""
+
+    def __init__(self):
+        self.rows = 0
+        self.written = 0
+        self.reset = 0
+        self.invalid = 0
+        self.errors: List[Tuple[int, str]] = []
+        self.started = time.monotonic()
+        self.finished = None
+
+    def error(self, row_number: int, message: str):
+        self.invalid += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((row_number, message))
+
+    def finish(self) -> 'ImportReport':
+        self.finished = time.monotonic()
+        return self
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rows_per_second(self) -> float:
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self) -> str:
+        return (
+            f'{self.rows} rows: {self.written} written, {self.reset} reset to '
+            f'default, {self.invalid} invalid in {self.elapsed:.2f}s '
+            f'({self.rows_per_second:.0f} rows/s)'
+        )
+
+
+def read_rows(stream: IO[str], format: str) -> Iterator[Row]:
+    """Read dictionaries from a `csv` file with a header row or `ndjson`.
+
+    A line that is not a JSON object is yielded as an `InvalidRow`, so it is
+    reported with its row number rather than ending the import.
+    """
+    if format == 'csv':
+        return csv.DictReader(stream)
+    if format == 'ndjson':
+        return read_json_lines(stream)
+    raise ValueError(f'Unknown format {format}')
+
+
+def read_json_lines(stream: IO[str]) -> Iterator[Row]:
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield InvalidRow(f'invalid JSON: {getattr(error, "msg", error)}')
+            continue
+        if isinstance(row, dict):
+            yield row
+        else:
+            yield InvalidRow('expected a JSON object')
+
+
+def batches(rows: Iterable[Row], size: int) -> Iterator[List[Tuple[int, Row]]]:
+    numbered = enumerate(rows, start=1)
+    while True:
+        batch = list(islice(numbered, size))
+        if not batch:
+            return
+        yield batch
+
+
+def serialize_values(
+    controller: KindController,
+    values: List[Any],
+    raw: bool,
+) -> List[Any]:
+    """Serialize the values of one kind, an exception takes the place of a bad value.
+
+    CSV values are already serialized strings, so `raw` values are parsed
+    first. Every value must survive a round trip through the serializer.
+    Pass the controllers of `IMPORT_KINDS` so BOOLEAN values are checked.
+    """
+    serialize = controller.serialize
+    deserialize = controller.deserialize
+    results = []
+    for value in values:
+        try:
+            if raw:
+                value = deserialize(value)
+            serialized = serialize(value)
+            deserialize(serialized)
+        except (AttributeError, TypeError, ValueError) as error:
+            serialized = error
+        results.append(serialized)
+    return results
+
+
+def import_overrides(
+    site_url: str,
+    rows: Iterable[Row],
+    raw: bool = False,
+    batch_size: int = IMPORT_BATCH_SIZE,
+) -> ImportReport:
+    """Create or reset the overrides from rows of `user_id`, `key` and `value`."""
+    report = ImportReport()
+    site = SiteController.get(site_url=site_url)
+    defaults = SiteController.defaults_by_key(site_url=site_url)
+    default_values = {
+        key: KINDS[default.kind].serialize(default.parsed) for key, default in defaults.items()
+    }
+
+    for batch in batches(rows, batch_size):
+        report.rows += len(batch)
+        by_kind: Dict[str, List[Tuple[int, str, str, Any]]] = {}
+        for row_number, row in batch:
+            if isinstance(row, InvalidRow):
+                report.error(row_number, row.message)
+                continue
+            key = row.get('key')
+            user_id = row.get('user_id')
+            if not user_id:
+                report.error(row_number, 'missing user_id')
+            elif not isinstance(key, str) or key not in defaults:
+                report.error(row_number, f'unknown key {key}')
+            elif defaults[key].deprecated:
+                report.error(row_number, f'deprecated key {key}')
+            elif row.get('value') is None:
+                report.error(row_number, f'missing value for key {key}')
+            else:
+                by_kind.setdefault(defaults[key].kind, []).append(
+                    (row_number, str(user_id), key, row.get('value')))
+
+        # The last row for a user and key wins.
+        values: Dict[Tuple[str, str], str] = {}
+        for kind, kind_rows in by_kind.items():
+            serialized = serialize_values(IMPORT_KINDS[kind], [row[3] for row in kind_rows], raw)
+            for (row_number, user_id, key, _value), value in zip(kind_rows, serialized):
+                if isinstance(value, Exception):
+                    report.error(row_number, f'expected {kind} for key {key}')
+                else:
+                    values[(user_id, key)] = value
+
+        if values:
+            _write_overrides(site, values, defaults, default_values, report)
+    return report.finish()
+
+
+def _write_overrides(site, values, defaults, default_values, report):
+    user_ids = list({user_id for user_id, _key in values})
+    overrides = []
+    changes = []
+    for (user_id, key), value in values.items():
+        if value == default_values[key]:
+            report.reset += 1
+            changes.append(Change(**Change.for_reset(site.url, user_id, key)))
+            continue
+        override = Override(
+            site=site,
+            user_id=user_id,
+            kind=defaults[key].kind,
+            key=key,
+            value=value,
+        )
+        overrides.append(override)
+        changes.append(Change(**Change.for_override(override)))
+
+    with transaction.atomic():
+        # There is no unique constraint to upsert against, so find the
+        # overrides being replaced and delete them by primary key.
+        existing = Override.objects.filter(
+            site=site,
+            user_id__in=user_ids,
+            key__in={key for _user_id, key in values},
+        ).values_list('uuid', 'user_id', 'key')
+        replaced = [uuid for uuid, user_id, key in existing if (user_id, key) in values]
+        Override.objects.filter(uuid__in=replaced).delete()
+        Override.objects.bulk_create(overrides)
+        Change.objects.bulk_create(changes)
+
+    report.written += len(overrides)
+    PreferenceController.invalidate_many(site.url, user_ids)
+
+
+def import_kinds(
+    site_url: str,
+    rows: Iterable[Row],
+    raw: bool = False,
+    batch_size: int = IMPORT_BATCH_SIZE,
+) -> ImportReport:
+    """Create or update the kinds from rows of `key`, `kind`, `value` and `deprecated`."""
+    report = ImportReport()
+    site = SiteController.get(site_url=site_url)
+
+    for batch in batches(rows, batch_size):
+        report.rows += len(batch)
+        by_kind: Dict[str, List[Tuple[int, Dict[str, Any]]]] = {}
+        for row_number, row in batch:
+            if isinstance(row, InvalidRow):
+                report.error(row_number, row.message)
+            elif not isinstance(row.get('key'), str) or not row['key']:
+                report.error(row_number, 'missing key')
+            elif row.get('kind') not in KINDS:
+                report.error(row_number, f'unknown kind {row.get("kind")}')
+            elif row.get('value') is None:
+                report.error(row_number, f'missing value for key {row["key"]}')
+            else:
+                by_kind.setdefault(row['kind'], []).append((row_number, row))
+
+        kinds: Dict[str, Kind] = {}
+        for kind, kind_rows in by_kind.items():
+            serialized = serialize_values(IMPORT_KINDS[kind], [row['value'] for _n, row in kind_rows], raw)
+            for (row_number, row), value in zip(kind_rows, serialized):
+                if isinstance(value, Exception):
+                    report.error(row_number, f'expected {kind} for key {row["key"]}')
+                    continue
+                deprecated = row.get('deprecated') or False
+                if isinstance(deprecated, str):
+                    deprecated = deprecated.lower() in ('1', 'on', 'true')
+                kinds[row['key']] = Kind(
+                    site=site,
+                    key=row['key'],
+                    kind=kind,
+                    value=value,
+                    deprecated=deprecated,
+                )
+
+        if kinds:
+            with transaction.atomic():
+                existing = {
+                    kind.key: kind
+                    for kind in Kind.objects.filter(site=site, key__in=list(kinds))
+                }
+                updated = []
+                for key, kind in kinds.items():
+                    if key in existing:
+                        kind.pk = existing[key].pk
+                        updated.append(kind)
+                Kind.objects.bulk_update(updated, ['kind', 'value', 'deprecated'])
+                Kind.objects.bulk_create([kind for kind in kinds.values() if kind.pk is None])
+                Change.objects.bulk_create([
+                    Change(
+                        site=site,
+                        key=kind.key,
+                        action=Change.DEFAULT_SET,
+                        kind=kind.kind,
+                        value=kind.value,
+                        deprecated=kind.deprecated,
+                    )
+                    for kind in kinds.values()
+                ])
+            report.written += len(kinds)
+
+    # Changing the defaults changes every user's preferences, bumping the
+    # site version takes care of all of them.
+    cache.delete(SiteController.defaults_cache_key(site_url))
+    SiteController.invalidate(site_url)
+    return report.finish()
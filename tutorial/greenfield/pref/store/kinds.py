@@ -14,6 +14,44 @@ class KindController(NamedTuple):
     deserialize: Callable[[str], Any]
 
 
+class FrozenDict(dict):
+    """A dict that can not be changed, for values shared between requests.
+
+    It is still a dict so the JSON encoders and equality work as usual.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f'{type(self).__name__} can not be changed')
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+
+class FrozenList(list):
+    """A list that can not be changed, for values shared between requests."""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f'{type(self).__name__} can not be changed')
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = clear = sort = reverse = _immutable
+
+    def __reduce__(self):
+        return (type(self), (list(self),))
+
+
+def freeze(value: Any) -> Any:
+    """Make a deserialized value safe to share, ie an OBJECT default."""
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return FrozenList(freeze(item) for item in value)
+    return value
+
+
 # The keys of this dict should be a ALLCAPS string with at most 10 characters.
 KINDS: Dict[str, KindController] = {
     'BOOLEAN': KindController(str, get_boolean),
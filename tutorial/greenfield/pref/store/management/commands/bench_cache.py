@@ -0,0 +1,63 @@
+import json
+import pickle
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from pref.store import models
+
+
+class Command(BaseCommand):
+    help = 'Compare the size and load time of the cached payload encodings.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kinds', type=int, default=50, help='Preferences per site')
+        parser.add_argument('--number', type=int, default=2000, help='Loads to time')
+
+    def handle(self, *args, **options):
+        site_url = 'https://example.com'
+        user_id = 'user-1234567890'
+        site = models.Site(url=site_url, auth_url='https://identity.example.com')
+        kinds = [
+            models.Kind(
+                site=site,
+                kind=('STRING', 'BOOLEAN', 'INTEGER', 'OBJECT')[i % 4],
+                key=f'preference-key-{i}',
+                value=('some string', 'true', '42', '{"a": [1, 2]}')[i % 4],
+            )
+            for i in range(options['kinds'])
+        ]
+        preferences = [kind.to_preference(user_id) for kind in kinds]
+        defaults = (1, {k.key: (k.kind, k.value, k.deprecated) for k in kinds})
+        cached_preferences = models.PreferenceController.encode(1, preferences)
+
+        def to_defaults(payload):
+            _version, entries = payload
+            return {
+                key: models.Default.create(site_url, kind, key, value, deprecated)
+                for key, (kind, value, deprecated) in entries.items()
+            }
+
+        def to_preferences(payload):
+            return models.PreferenceController.decode(site_url, user_id, payload)
+
+        # The cache backends pickle every value they store, so each row is
+        # measured as the pickled bytes and the time to get back the objects
+        # the controllers hand out. The json rows are for reference only.
+        rows = [
+            ('defaults', 'models', kinds, lambda payload: payload),
+            ('defaults', 'compact', defaults, to_defaults),
+            ('defaults', 'json', json.dumps(defaults), lambda payload: to_defaults(json.loads(payload))),
+            ('preferences', 'models', (1, preferences), lambda payload: payload),
+            ('preferences', 'compact', cached_preferences, to_preferences),
+            ('preferences', 'json', json.dumps(cached_preferences), lambda payload: to_preferences(json.loads(payload))),
+        ]
+
+        number = options['number']
+        self.stdout.write(f'{len(kinds)} preferences, {number} loads each')
+        self.stdout.write(f'{"payload":<12} {"encoding":<8} {"bytes":>8} {"usec/load":>10}')
+        for name, encoding, value, decode in rows:
+            data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            seconds = timeit.timeit(lambda: decode(pickle.loads(data)), number=number)
+            self.stdout.write(
+                f'{name:<12} {encoding:<8} {len(data):>8} {seconds / number * 1e6:>10.1f}')
@@ -0,0 +1,29 @@
+import uuid
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pref.store.exports import EXPORT_CHUNK_SIZE, iter_overrides
+from pref.store.models import InvalidSite
+
+
+class Command(BaseCommand):
+    help = 'Write every override of a site to stdout as newline delimited JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('site', help='Url of the site to export')
+        parser.add_argument('--after', type=uuid.UUID, help='Resume after this cursor')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                            help='Rows fetched from the database at a time')
+
+    def handle(self, *args, **options):
+        try:
+            lines = iter_overrides(
+                options['site'],
+                after=options['after'],
+                chunk_size=options['chunk_size'],
+            )
+        except InvalidSite:
+            raise CommandError(f'Unknown site {options["site"]}')
+
+        for line in lines:
+            self.stdout.write(line.decode('utf-8'), ending='')
@@ -0,0 +1,50 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pref.store import imports
+from pref.store.models import InvalidSite
+
+
+class Command(BaseCommand):
+    help = 'Bulk import the kinds or overrides of a site from a CSV or NDJSON file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('site', help='Url of the site to import into')
+        parser.add_argument('type', choices=['kinds', 'overrides'], help='What the rows are')
+        parser.add_argument('path', help='File to read, or - for stdin')
+        parser.add_argument('--format', choices=['csv', 'ndjson'],
+                            help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=imports.IMPORT_BATCH_SIZE,
+                            help='Rows written in each transaction')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        format = options['format']
+        if format is None:
+            extension = os.path.splitext(path)[1].lstrip('.').lower()
+            format = 'csv' if extension == 'csv' else 'ndjson'
+
+        import_rows = {
+            'kinds': imports.import_kinds,
+            'overrides': imports.import_overrides,
+        }[options['type']]
+
+        stream = sys.stdin if path == '-' else open(path, newline='')
+        try:
+            report = import_rows(
+                options['site'],
+                imports.read_rows(stream, format),
+                raw=format == 'csv',
+                batch_size=options['batch_size'],
+            )
+        except InvalidSite:
+            raise CommandError(f'Unknown site {options["site"]}')
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        for row_number, message in report.errors:
+            self.stderr.write(f'row {row_number}: {message}')
+        self.stdout.write(str(report))
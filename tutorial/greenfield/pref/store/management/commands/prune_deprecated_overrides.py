@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from pref.store import pruning
+
+
+class Command(BaseCommand):
+    help = 'Delete the overrides of deprecated kinds in small batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--site', help='Only prune the kinds of this site')
+        parser.add_argument('--batch-size', type=int, default=pruning.PRUNE_BATCH_SIZE,
+                            help='Overrides deleted in each transaction')
+        parser.add_argument('--pause', type=float, default=pruning.PRUNE_PAUSE,
+                            help='Seconds to wait between batches')
+        parser.add_argument('--max-batches', type=int,
+                            help='Stop after this many batches, run again to continue')
+
+    def handle(self, *args, **options):
+        deleted = pruning.prune_deprecated_overrides(
+            site_url=options['site'],
+            batch_size=options['batch_size'],
+            pause=options['pause'],
+            max_batches=options['max_batches'],
+        )
+        self.stdout.write(f'{deleted} overrides pruned')
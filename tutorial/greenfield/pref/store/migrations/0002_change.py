@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('user_id', models.CharField(blank=True, max_length=255)),
+                ('key', models.CharField(max_length=255)),
+                ('action', models.CharField(choices=[('set', 'Override set'), ('reset', 'Override reset to default'), ('default_set', 'Default set'), ('default_del', 'Default deleted')], max_length=12)),
+                ('kind', models.CharField(blank=True, choices=[('BOOLEAN', 'Boolean'), ('INTEGER', 'Integer'), ('NUMBER', 'Number'), ('OBJECT', 'Object'), ('STRING', 'String')], max_length=10)),
+                ('value', models.TextField(null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('site', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='store.site')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['site', 'id'], name='site_change_idx')],
+            },
+        ),
+    ]
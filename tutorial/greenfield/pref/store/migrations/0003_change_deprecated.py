@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0002_change'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='change',
+            name='deprecated',
+            field=models.BooleanField(default=False),
+        ),
+    ]
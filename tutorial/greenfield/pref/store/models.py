@@ -1,14 +1,19 @@
-
 import json
 import uuid
-from typing import List, Any, NamedTuple
+from datetime import timedelta
+from types import MappingProxyType
+from typing import Any, Dict, FrozenSet, List, Mapping, NamedTuple, Tuple
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
 from django.core.cache import cache
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
-from .kinds import KindController, KIND_CHOICES, KINDS
+from . import caching, encoders, identity
+from .identity import IdentityError, InvalidToken  # noqa: F401
+from .kinds import KindController, KIND_CHOICES, KINDS, freeze
 
 
 class InvalidSite(Exception):
@@ -19,6 +24,10 @@ class InvalidKey(Exception):
     pass
 
 
+class NotAllowed(Exception):
+    pass
+
+
 class Preference(NamedTuple):
     """Our preferences are the union of the site defaults and overrides"""
     site_url: str
@@ -38,6 +47,45 @@ class Preference(NamedTuple):
         return self._kind.deserialize(self.value)
 
 
+# Pickled model instances and NamedTuples carry the class path, the model
+# `_state` and the site and user on every entry. So the cache only holds
+# plain `key -> (kind, value, ...)` mappings which are smaller and quicker to
+# load, run `manage.py bench_cache` to compare.
+CachedDefaults = Tuple[int, Dict[str, Tuple[str, str, bool]]]
+CachedPreferences = Tuple[Tuple[int, int], Dict[str, Tuple[str, Any]]]
+
+
+class Default(NamedTuple):
+    """The default for a preference, as the site defaults are cached"""
+    site_url: str
+    kind: str
+    key: str
+    value: str
+    deprecated: bool
+    # The deserialized value, it is frozen since it is shared by the
+    # preferences of every user of the site.
+    parsed: Any
+
+    @classmethod
+    def create(cls, site_url: str, kind: str, key: str, value: str, deprecated: bool) -> 'Default':
+        return cls(site_url, kind, key, value, deprecated, freeze(KINDS[kind].deserialize(value)))
+
+    @property
+    def _kind(self) -> KindController:
+        return KINDS[self.kind]
+
+    def serialize(self, new_value: Any = None) -> str:
+        if new_value is None:
+            return self._kind.serialize(self.value)
+        return self._kind.serialize(new_value)
+
+    def deserialize(self) -> Any:
+        return self.parsed
+
+    def to_preference(self, user_id: str) -> Preference:
+        return Preference(self.site_url, user_id, self.kind, self.key, self.parsed)
+
+
 class Site(models.Model):
     """A website that uses preferences."""
 
@@ -47,6 +95,18 @@ class Site(models.Model):
     def __str__(self) -> str:
         return self.url
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # After the commit, like `Serializable`, so a reader can not cache
+        # the old row under the new version.
+        url = self.url
+        transaction.on_commit(lambda: SiteController.invalidate(url))
+
+    def delete(self, *args, **kwargs):
+        url = self.url
+        super().delete(*args, **kwargs)
+        transaction.on_commit(lambda: SiteController.invalidate(url))
+
 
 class Serializable(models.Model):
     """Abstract model which provides methods to handle our custom fields."""
@@ -77,6 +137,9 @@ class Serializable(models.Model):
     def get_cache_key(self) -> str:
         raise NotImplementedError('Subclasses must provide `get_cache_key`')
 
+    def get_cache_keys(self) -> List[str]:
+        return [self.get_cache_key()]
+
     def clean(self):
         # If we do not have a kind don't bother checking the default field.
         if not self.kind:
@@ -90,21 +153,24 @@ class Serializable(models.Model):
         except json.decoder.JSONDecodeError:
             raise ValidationError({'value': _('Unable to decode JSON object')})
 
+    def invalidate_cache(self):
+        cache.delete_many(self.get_cache_keys())
+
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
         # Clear the cache for our site defaults. Allows us to use the
         # django admin to create these models, and still work with our
-        # custom site controller.
-        _cache_key = self.get_cache_key()
-        cache.delete(_cache_key)
+        # custom site controller. Subclasses save in a transaction, and
+        # clearing it before the commit would let a reader cache the old
+        # rows under the new version.
+        transaction.on_commit(self.invalidate_cache)
 
     def delete(self, *args, **kwargs):
         # Clear the cache for our site defaults. Allows us to use the
         # django admin to create these models, and still work with our
         # custom site controller.
-        _cache_key = self.get_cache_key()
-        cache.delete(_cache_key)
         super().delete(*args, **kwargs)
+        transaction.on_commit(self.invalidate_cache)
 
 
 class Kind(Serializable):
@@ -118,10 +184,38 @@ class Kind(Serializable):
         return f'{self.site} - {self.key}'
 
     def get_cache_key(self) -> str:
-        return SiteController.defaults_cache_key(self.site)
+        return SiteController.defaults_cache_key(self.site_id)
+
+    def invalidate_cache(self):
+        super().invalidate_cache()
+        SiteController.invalidate(self.site_id)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            Change.objects.create(
+                site_id=self.site_id,
+                key=self.key,
+                action=Change.DEFAULT_SET,
+                kind=self.kind,
+                value=self.value,
+                deprecated=self.deprecated,
+            )
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            super().delete(*args, **kwargs)
+            Change.objects.create(
+                site_id=self.site_id,
+                key=self.key,
+                action=Change.DEFAULT_DELETE,
+            )
 
     def to_preference(self, user_id) -> Preference:
-        return Preference(self.site.pk, user_id, self.kind, self.key, self.deserialize())
+        return Preference(self.site_id, user_id, self.kind, self.key, self.deserialize())
+
+    def to_default(self) -> Default:
+        return Default.create(self.site_id, self.kind, self.key, self.value, self.deprecated)
 
 
 class Override(Serializable):
@@ -142,14 +236,105 @@ class Override(Serializable):
         return self.key
 
     def to_preference(self) -> Preference:
-        return Preference(self.site.pk, self.user_id, self.kind, self.key, self.deserialize())
+        return Preference(self.site_id, self.user_id, self.kind, self.key, self.deserialize())
 
     def get_cache_key(self) -> str:
-        return PreferenceController.cache_key(self.site, self.user_id)
+        return PreferenceController.cache_key(self.site_id, self.user_id)
 
+    def invalidate_cache(self):
+        # Bump the version as well, otherwise a write through that started
+        # before this change could put the old list back in the cache.
+        super().invalidate_cache()
+        PreferenceController.bump_version(self.site_id, self.user_id)
 
-def get_user_id(auth_url: str, token: str) -> str:
-    pass
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            Change.objects.create(**Change.for_override(self))
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            super().delete(*args, **kwargs)
+            Change.objects.create(**Change.for_reset(self.site_id, self.user_id, self.key))
+
+
+class Change(models.Model):
+    """An append only log of the changes to the preferences of a site.
+
+    Every write to an Override or Kind adds a row in the same transaction.
+    The id is the cursor, consumers ask for the changes after the last id
+    they have seen rather than polling every user's preferences. Ids are
+    handed out at insert, so a slow transaction can commit a lower id after
+    a higher one was read. Changes are only served once they are
+    `PreferenceController.CHANGES_DELAY` seconds old, by then the
+    transactions that took the lower ids have committed.
+    """
+    OVERRIDE_SET = 'set'
+    OVERRIDE_RESET = 'reset'
+    DEFAULT_SET = 'default_set'
+    DEFAULT_DELETE = 'default_del'
+    ACTION_CHOICES = [
+        (OVERRIDE_SET, _('Override set')),
+        (OVERRIDE_RESET, _('Override reset to default')),
+        (DEFAULT_SET, _('Default set')),
+        (DEFAULT_DELETE, _('Default deleted')),
+    ]
+
+    id = models.BigAutoField(primary_key=True)
+    site = models.ForeignKey('Site', on_delete=models.CASCADE)
+    # Empty for changes to the site defaults.
+    user_id = models.CharField(max_length=255, blank=True)
+    key = models.CharField(max_length=255)
+    action = models.CharField(max_length=12, choices=ACTION_CHOICES)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, blank=True)
+    # The serialized value, null when the key goes back to the default.
+    value = models.TextField(null=True)
+    # Whether the kind is deprecated, for changes to the site defaults.
+    deprecated = models.BooleanField(default=False)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['site', 'id'], name='site_change_idx'),
+        ]
+
+    def __str__(self) -> str:
+        return f'{self.id} {self.action} {self.key}'
+
+    @classmethod
+    def for_override(cls, override: 'Override') -> dict:
+        return {
+            'site_id': override.site_id,
+            'user_id': override.user_id,
+            'key': override.key,
+            'action': cls.OVERRIDE_SET,
+            'kind': override.kind,
+            'value': override.value,
+        }
+
+    @classmethod
+    def for_reset(cls, site_url: str, user_id: str, key: str) -> dict:
+        return {
+            'site_id': site_url,
+            'user_id': user_id,
+            'key': key,
+            'action': cls.OVERRIDE_RESET,
+        }
+
+    def to_dict(self) -> dict:
+        value = None
+        if self.value is not None:
+            value = KINDS[self.kind].deserialize(self.value)
+        return {
+            'cursor': str(self.id),
+            'action': self.action,
+            'user_id': self.user_id or None,
+            'key': self.key,
+            'kind': self.kind or None,
+            'value': value,
+            'deprecated': self.deprecated,
+            'created': self.created.isoformat(),
+        }
 
 
 class PreferenceController:
@@ -164,17 +349,165 @@ class PreferenceController:
     store the unique user_id in our tables.
     """
 
+    # Maximum number of user ids in a single `user_id__in` query.
+    BULK_CHUNK_SIZE = 500
+
+    # Maximum number of changes returned by `changes` at once.
+    CHANGES_PAGE_SIZE = 500
+
+    # Seconds a change is held back before it is served, longer than any
+    # write transaction, so no lower id can commit behind a served cursor.
+    CHANGES_DELAY = 5
+
     @classmethod
     def get_user_id(cls, site_url: str, token: str) -> str:
         auth_url = SiteController.auth_url(site_url)
         assert auth_url
-        # try to auth or raise an error
-        return auth_url
+        return identity.token_cache.get_user_id(auth_url, token)
+
+    @classmethod
+    def get_service_user_id(cls, site_url: str, token: str) -> str:
+        """The user id of a service allowed to read every user of the site.
+
+        Any end user has a valid token, so reading other users' preferences
+        also requires the user to be listed for the site in the
+        `PREF_SERVICE_USERS` setting.
+        """
+        user_id = cls.get_user_id(site_url=site_url, token=token)
+        service_users = getattr(settings, 'PREF_SERVICE_USERS', {})
+        if user_id not in service_users.get(site_url, ()):
+            raise NotAllowed
+        return user_id
 
     @classmethod
     def cache_key(cls, site_url: str, user_id: str) -> str:
         return f'preferences:{site_url}:{user_id}'
 
+    @classmethod
+    def version_cache_key(cls, site_url: str, user_id: str) -> str:
+        return f'preferences_version:{site_url}:{user_id}'
+
+    @classmethod
+    def payload_cache_key(cls, site_url: str, user_id: str) -> str:
+        return f'preferences_payload:{site_url}:{user_id}'
+
+    @classmethod
+    def encode(cls, version: Tuple[int, int], preferences: List[Preference]) -> CachedPreferences:
+        # The site and user are part of the cache key, so only store the
+        # `key -> (kind, value)` mapping for each preference.
+        return version, {p.key: (p.kind, p.value) for p in preferences}
+
+    @classmethod
+    def decode(
+        cls,
+        site_url: str,
+        user_id: str,
+        payload: CachedPreferences,
+    ) -> Tuple[Tuple[int, int], List[Preference]]:
+        version, entries = payload
+        # Skip the NamedTuple `__new__` argument handling, it is half the
+        # cost of loading a cached preference list.
+        new = tuple.__new__
+        return version, [
+            new(Preference, (site_url, user_id, kind, key, value))
+            for key, (kind, value) in entries.items()
+        ]
+
+    @classmethod
+    def version(cls, site_url: str, user_id: str) -> Tuple[int, int]:
+        """The version of the site defaults and of the user's overrides.
+
+        Together they identify the user's preference list, a cached list is
+        only used while both match.
+        """
+        return caching.get_versions(
+            SiteController.version_cache_key(site_url),
+            cls.version_cache_key(site_url, user_id),
+        )
+
+    @classmethod
+    def etag(cls, auth_token: str, site_url: str) -> str:
+        """An ETag for the user's preferences that changes on every write."""
+        user_id = cls.get_user_id(site_url=site_url, token=auth_token)
+        return '"%s-%s"' % cls.version(site_url, user_id)
+
+    @classmethod
+    def bump_version(cls, site_url: str, user_id: str) -> int:
+        """Atomically increment the version of the user's preferences."""
+        return caching.bump_version(cls.version_cache_key(site_url, user_id))
+
+    @classmethod
+    def invalidate_many(cls, site_url: str, user_ids: List[str]):
+        """Drop the cached preferences of many users with two round trips."""
+        cache.delete_many(
+            [cls.cache_key(site_url, user_id) for user_id in user_ids]
+            + [cls.payload_cache_key(site_url, user_id) for user_id in user_ids]
+        )
+        caching.reset_versions([cls.version_cache_key(site_url, user_id) for user_id in user_ids])
+
+    @classmethod
+    def write_through(
+        cls,
+        site_url: str,
+        user_id: str,
+        preferences: List[Preference],
+    ):
+        """Patch the cached preference list after the overrides are written.
+
+        The cached list is stored with the version it was built from. Each
+        write increments the user's version, and only the writer that moved
+        it from the cached version to the next one may patch the list. If another
+        write got in between the list is left alone, the versions no longer
+        match and the next read rebuilds it from the database.
+        """
+        version = cls.bump_version(site_url, user_id)
+        _cache_key = cls.cache_key(site_url, user_id)
+        payload = cache.get(_cache_key)
+        if payload is None:
+            return
+        (site_version, user_version), cached = cls.decode(site_url, user_id, payload)
+        if user_version != version - 1:
+            return
+
+        # If the site defaults changed the list is already out of date, so
+        # keeping its site version means it is still rebuilt on the next read.
+        preference_mapping = {p.key: p for p in cached}
+        preference_mapping.update({p.key: p for p in preferences})
+        results = list(preference_mapping.values())
+        cache.set(_cache_key, cls.encode((site_version, version), results), 600)
+
+    @classmethod
+    def build(
+        cls,
+        site_url: str,
+        user_id: str,
+        site_version: int = None,
+    ) -> List[Preference]:
+        # Gather all the defaults for the site then merge in overrides. The
+        # list is cached under `site_version`, so the defaults must be the
+        # ones loaded under it and not an older copy held by this process.
+        defaults = SiteController.defaults(site_url=site_url, version=site_version)
+        preferences_from_defaults = map(
+            lambda default: default.to_preference(user_id),
+            defaults
+        )
+        preference_mapping = {p.key: p for p in preferences_from_defaults}
+
+        # Gather any overrides and update the mapping, the overrides of
+        # deprecated kinds are left for `prune_deprecated_overrides`.
+        deprecated = SiteController.deprecated_keys(site_url=site_url, version=site_version)
+        overrides = Override.objects.filter(site__pk=site_url, user_id=user_id)
+        preferences_from_overrides = map(
+            lambda override: override.to_preference(),
+            overrides
+        )
+        override_mapping = {
+            p.key: p for p in preferences_from_overrides if p.key not in deprecated
+        }
+
+        preference_mapping.update(override_mapping)
+        return list(preference_mapping.values())
+
     @classmethod
     def get(
         cls,
@@ -183,30 +516,183 @@ class PreferenceController:
     ) -> List[Preference]:
 
         user_id = cls.get_user_id(site_url=site_url, token=auth_token)
+        return cls.get_for_user(site_url, user_id)
+
+    @classmethod
+    def get_for_user(cls, site_url: str, user_id: str) -> List[Preference]:
         _cache_key = cls.cache_key(site_url, user_id)
-        results = cache.get(_cache_key)
-        if results is None:
-            # Gather all the defaults for the site then merge in overrides.
-            defaults = SiteController.defaults(site_url=site_url)
-            preferences_from_defaults = map(
-                lambda default: default.to_preference(user_id),
-                defaults
-            )
-            preference_mapping = {p.key: p for p in preferences_from_defaults}
+        _site_version_key = SiteController.version_cache_key(site_url)
+        _version_key = cls.version_cache_key(site_url, user_id)
+        cached = cache.get_many([_cache_key, _site_version_key, _version_key])
+        version = (cached.get(_site_version_key), cached.get(_version_key))
+        if _cache_key in cached:
+            cached_version, results = cls.decode(site_url, user_id, cached[_cache_key])
+            if cached_version == version:
+                return results
+
+        # Read the version before the database so a write that lands while
+        # we build the list leaves us with an outdated version.
+        if None in version:
+            version = cls.version(site_url, user_id)
+        results = cls.build(site_url, user_id, site_version=version[0])
+        cache.set(_cache_key, cls.encode(version, results), 600)
+        return results
 
-            # Gather any overrides and update the mapping
-            overrides = Override.objects.filter(site__pk=site_url, user_id=user_id)
-            preferences_from_overrides = map(
-                lambda override: override.to_preference(),
-                overrides
-            )
-            override_mapping = {p.key: p for p in preferences_from_overrides}
+    @classmethod
+    def overrides(
+        cls,
+        auth_token: str,
+        site_url: str,
+    ) -> Tuple[Tuple[int, int], Dict[str, Any]]:
+        """The user's preferences that differ from the site defaults.
+
+        Returned with the version of the defaults and of the user's
+        overrides. Along with a `SiteController.snapshot` of the same
+        defaults version this is enough to build the full preference list.
+        """
+        user_id = cls.get_user_id(site_url=site_url, token=auth_token)
+        version = cls.version(site_url, user_id)
+        defaults = SiteController.defaults_by_key(site_url, version=version[0])
+        overrides = {
+            p.key: p.value
+            for p in cls.get_for_user(site_url, user_id)
+            if p.key not in defaults or p.value != defaults[p.key].parsed
+        }
+        return version, overrides
+
+    @classmethod
+    def get_payload(cls, auth_token: str, site_url: str) -> bytes:
+        """The user's preferences as a JSON encoded list.
+
+        The bytes are cached next to the preference list under the same
+        versions, so a hit goes straight to the response without building
+        any dicts or encoding anything.
+        """
+        user_id = cls.get_user_id(site_url=site_url, token=auth_token)
+        _payload_key = cls.payload_cache_key(site_url, user_id)
+        _site_version_key = SiteController.version_cache_key(site_url)
+        _version_key = cls.version_cache_key(site_url, user_id)
+        cached = cache.get_many([_payload_key, _site_version_key, _version_key])
+        version = (cached.get(_site_version_key), cached.get(_version_key))
+        if _payload_key in cached and cached[_payload_key][0] == version:
+            return cached[_payload_key][1]
+
+        if None in version:
+            version = cls.version(site_url, user_id)
+        preferences = cls.get_for_user(site_url, user_id)
+        payload = encoders.dumps([p._asdict() for p in preferences])
+        cache.set(_payload_key, (version, payload), 600)
+        return payload
+
+    @classmethod
+    def get_many(
+        cls,
+        auth_token: str,
+        site_url: str,
+        user_ids: List[str],
+    ) -> Dict[str, List[Preference]]:
+        """Fetch the preferences for many users at once.
+
+        This is for jobs like notification fan out which need preferences for
+        thousands of users. Cached users come back from a single `get_many`
+        call. The overrides for every missing user are fetched with
+        `user_id__in` queries over the `site_user_idx` index, in chunks of
+        `BULK_CHUNK_SIZE` to stay under the database parameter limits.
+        Only service users may call it.
+        """
+        cls.get_service_user_id(site_url=site_url, token=auth_token)
+        user_ids = list(dict.fromkeys(user_ids))
+        cache_keys = {
+            user_id: (cls.cache_key(site_url, user_id), cls.version_cache_key(site_url, user_id))
+            for user_id in user_ids
+        }
+        _site_version_key = SiteController.version_cache_key(site_url)
+        cached = cache.get_many(
+            [_site_version_key] + [key for keys in cache_keys.values() for key in keys])
+        site_version = cached.get(_site_version_key)
+        results = {}
+        versions = {}
+        for user_id, (_cache_key, _version_key) in cache_keys.items():
+            version = (site_version, cached.get(_version_key))
+            if _cache_key in cached:
+                cached_version, preferences = cls.decode(site_url, user_id, cached[_cache_key])
+                if cached_version == version:
+                    results[user_id] = preferences
+                    continue
+            versions[user_id] = version
+
+        missing = [user_id for user_id in user_ids if user_id not in results]
+        if missing:
+            # Every list is built from the same defaults, so they are all
+            # stamped with the one site version the defaults are loaded at.
+            # The versions that do not exist yet are created in bulk.
+            absent = [
+                cache_keys[user_id][1] for user_id in missing if versions[user_id][1] is None
+            ]
+            if site_version is None:
+                absent.append(_site_version_key)
+            created = caching.init_versions(absent) if absent else {}
+            site_version = created.get(_site_version_key, site_version)
+            for user_id in missing:
+                user_version = versions[user_id][1]
+                if user_version is None:
+                    user_version = created[cache_keys[user_id][1]]
+                versions[user_id] = (site_version, user_version)
+
+            defaults = [
+                (default.kind, default.key, default.parsed)
+                for default in SiteController.defaults(site_url=site_url, version=site_version)
+            ]
+            deprecated = SiteController.deprecated_keys(site_url=site_url, version=site_version)
+            overrides: Dict[str, List[Preference]] = {user_id: [] for user_id in missing}
+            for start in range(0, len(missing), cls.BULK_CHUNK_SIZE):
+                chunk = missing[start:start + cls.BULK_CHUNK_SIZE]
+                query = Override.objects.filter(site__pk=site_url, user_id__in=chunk)
+                for override in query:
+                    if override.key not in deprecated:
+                        overrides[override.user_id].append(override.to_preference())
+
+            to_cache = {}
+            for user_id in missing:
+                preference_mapping = {
+                    key: Preference(site_url, user_id, kind, key, value)
+                    for kind, key, value in defaults
+                }
+                preference_mapping.update({p.key: p for p in overrides[user_id]})
+                results[user_id] = list(preference_mapping.values())
+                to_cache[cls.cache_key(site_url, user_id)] = cls.encode(
+                    versions[user_id], results[user_id])
+            cache.set_many(to_cache, 600)
 
-            preference_mapping.update(override_mapping)
-            results = list(preference_mapping.values())
-            cache.set(_cache_key, results, 600)
         return results
 
+    @classmethod
+    def changes(
+        cls,
+        auth_token: str,
+        site_url: str,
+        since: int = 0,
+        limit: int = CHANGES_PAGE_SIZE,
+    ) -> List[Change]:
+        """The changes to the site after the `since` cursor, oldest first.
+
+        A page is a range scan of the `site_change_idx` index, so syncing
+        costs the number of changes rather than every user and key. Changes
+        newer than `CHANGES_DELAY` seconds are left for the next page. Only
+        service users may call it, the changes are for every user.
+        """
+        cls.get_service_user_id(site_url=site_url, token=auth_token)
+        SiteController.get(site_url=site_url)
+        settled = timezone.now() - timedelta(seconds=cls.CHANGES_DELAY)
+        changes = []
+        for change in Change.objects.filter(site__pk=site_url, id__gt=since).order_by('id')[:limit]:
+            # Stop at the first recent change rather than skip over it, the
+            # cursor must never pass a change that has not been served.
+            if change.created > settled:
+                break
+            changes.append(change)
+        return changes
+
     @classmethod
     def update(
         cls,
@@ -238,33 +724,154 @@ class PreferenceController:
 
         reset_to_default = (default_for_site == serialize_custom_value)
 
+        # The queryset methods skip `Override.save`, which would bump the
+        # version and stop us from patching the cached list below.
+        overrides = Override.objects.filter(site__pk=site_url, user_id=user_id, key=key)
         if reset_to_default:
+            with transaction.atomic():
+                overrides.delete()
+                Change.objects.create(**Change.for_reset(site_url, user_id, key))
+            preference = site_default.to_preference(user_id=user_id)
+        else:
+            site = SiteController.get(site_url=site_url)
+            override = Override(
+                site=site,
+                user_id=user_id,
+                kind=kind,
+                key=key,
+                value=serialize_custom_value,
+            )
+            with transaction.atomic():
+                if not overrides.update(kind=kind, value=serialize_custom_value):
+                    Override.objects.bulk_create([override])
+                Change.objects.create(**Change.for_override(override))
+            preference = override.to_preference()
+
+        cls.write_through(site_url, user_id, [preference])
+        return preference
+
+    @classmethod
+    def update_many(
+        cls,
+        auth_token: str,
+        site_url: str,
+        values: Dict[str, Any],
+    ) -> List[Preference]:
+        """Create or Delete the Overrides for many keys at once.
+
+        Works the same as `update` but every key is validated against a
+        single load of the site defaults. Then all the writes happen in one
+        transaction, a bulk delete of the old overrides followed by a
+        `bulk_create` of the new ones. The cached preference list is
+        patched once at the end.
+        """
+        user_id = cls.get_user_id(site_url=site_url, token=auth_token)
+        site = SiteController.get(site_url=site_url)
+        defaults = SiteController.defaults_by_key(site_url=site_url)
+
+        results = []
+        new_overrides = []
+        changes = []
+        for key, value in values.items():
+            site_default = defaults.get(key)
+            if site_default is None or site_default.deprecated:
+                raise InvalidKey(key)
+
+            kind = site_default.kind
+            try:
+                serialize_custom_value = site_default.serialize(value)
+            except Exception:
+                raise ValueError(f'Expected {kind} for key {key}')
+
+            if site_default.serialize() == serialize_custom_value:
+                results.append(site_default.to_preference(user_id=user_id))
+                changes.append(Change(**Change.for_reset(site_url, user_id, key)))
+                continue
+
+            override = Override(
+                site=site,
+                user_id=user_id,
+                kind=kind,
+                key=key,
+                value=serialize_custom_value,
+            )
+            new_overrides.append(override)
+            results.append(override.to_preference())
+            changes.append(Change(**Change.for_override(override)))
+
+        # Every key either goes back to the default or gets a new value, so
+        # we can clear all the existing overrides before creating new ones.
+        with transaction.atomic():
             Override.objects.filter(
                 site__pk=site_url,
                 user_id=user_id,
-                key=key,
+                key__in=list(values),
             ).delete()
-            return site_default.to_preference(user_id=user_id)
+            Override.objects.bulk_create(new_overrides)
+            Change.objects.bulk_create(changes)
 
-        site = SiteController.get(site_url=site_url)
-        override, _created = Override.objects.update_or_create(
-            site=site,
-            user_id=user_id,
-            kind=kind,
-            key=key,
-            defaults={'value': serialize_custom_value}
-        )
-        return override.to_preference()
+        cls.write_through(site_url, user_id, results)
+        return results
 
 
 class SiteController:
 
+    # Sites and their defaults are needed on every request and almost never
+    # change. So they are kept in process and the site version key is only
+    # checked every `ttl` seconds, saving a site or kind bumps the version.
+    local_cache = caching.LocalCache(max_entries=1000, ttl=10)
+
     @classmethod
     def cache_key(cls, site_url: str) -> str:
         return f'site:{site_url}'
 
+    @classmethod
+    def version_cache_key(cls, site_url: str) -> str:
+        return f'site_version:{site_url}'
+
+    @classmethod
+    def invalidate(cls, site_url: str):
+        """Clear the cached site and defaults in every worker."""
+        cache.delete_many([cls.cache_key(site_url), cls.auth_url_cache_key(site_url)])
+        caching.bump_version(cls.version_cache_key(site_url))
+        cls.local_cache.discard(
+            ('site', site_url),
+            ('auth_url', site_url),
+            ('defaults', site_url),
+            ('deprecated', site_url),
+            ('snapshot', site_url),
+        )
+
+    @classmethod
+    def _cached(cls, name: str, site_url: str, load, version: int = None):
+        """Get `name` for the site from the local cache.
+
+        Reading the site version creates it, so the site is looked up first
+        and an unknown url raises `InvalidSite` without leaving a version
+        key behind.
+        """
+        if (name, site_url) not in cls.local_cache:
+            if name == 'site':
+                cls._get(site_url)
+            else:
+                cls.get(site_url)
+        return cls.local_cache.get(
+            (name, site_url),
+            cls.version_cache_key(site_url),
+            load,
+            version=version,
+        )
+
     @classmethod
     def get(cls, site_url: str) -> Site:
+        return cls._cached(
+            'site',
+            site_url,
+            lambda: cls._get(site_url),
+        )
+
+    @classmethod
+    def _get(cls, site_url: str) -> Site:
         _cache_key = cls.cache_key(site_url)
         site = cache.get(_cache_key)
         if site is None:
@@ -281,6 +888,14 @@ class SiteController:
 
     @classmethod
     def auth_url(cls, site_url: str) -> str:
+        return cls._cached(
+            'auth_url',
+            site_url,
+            lambda: cls._auth_url(site_url),
+        )
+
+    @classmethod
+    def _auth_url(cls, site_url: str) -> str:
         _cache_key = cls.auth_url_cache_key(site_url)
         auth_url = cache.get(_cache_key)
         if auth_url is None:
@@ -295,21 +910,113 @@ class SiteController:
         return f'site_defaults:{site_url}'
 
     @classmethod
-    def defaults(cls, site_url: str) -> List[Kind]:
-        site = cls.get(site_url)
-        _cache_key = cls.defaults_cache_key(site_url)
-        defaults = cache.get(_cache_key)
-        if defaults is None:
-            defaults = list(Kind.objects.filter(site=site))
-            cache.set(_cache_key, defaults, 60 * 60)
-        return defaults
+    def _cache_defaults(cls, site: Site, site_url: str, version: int) -> CachedDefaults:
+        kinds = Kind.objects.filter(site=site).values_list('key', 'kind', 'value', 'deprecated')
+        payload = version, {
+            key: (kind, value, deprecated) for key, kind, value, deprecated in kinds
+        }
+        cache.set(cls.defaults_cache_key(site_url), payload, 60 * 60)
+        return payload
 
     @classmethod
-    def default_for_key(cls, site_url: str, key: str) -> Kind:
+    def defaults(cls, site_url: str, version: int = None) -> List[Default]:
+        """The defaults users see, deprecated kinds are left out."""
+        return [
+            default for default in cls.defaults_by_key(site_url, version=version).values()
+            if not default.deprecated
+        ]
+
+    @classmethod
+    def deprecated_keys(cls, site_url: str, version: int = None) -> FrozenSet[str]:
+        """The keys of the deprecated kinds, their overrides are skipped on read.
+
+        Deprecating a kind only changes the one row and bumps the site
+        version. The overrides are left in place until they are pruned in
+        the background, or come back if the kind is restored.
+        """
+        return cls._cached(
+            'deprecated',
+            site_url,
+            lambda: frozenset(
+                key for key, default in cls.defaults_by_key(site_url, version=version).items()
+                if default.deprecated
+            ),
+            version=version,
+        )
+
+    @classmethod
+    def defaults_by_key(cls, site_url: str, version: int = None) -> Mapping[str, Default]:
+        """The site defaults by key.
+
+        The defaults are deserialized once per version of the site's kinds
+        in each process, and the read only mapping is shared by every user.
+        Pass the site `version` when the result is cached under it, the
+        defaults are then loaded at that version rather than served from an
+        in process copy that may be up to `ttl` seconds old.
+        """
+        return cls._cached(
+            'defaults',
+            site_url,
+            lambda: cls._defaults_by_key(site_url, version),
+            version=version,
+        )
+
+    @classmethod
+    def _defaults_by_key(cls, site_url: str, version: int = None) -> Mapping[str, Default]:
         site = cls.get(site_url)
+        if version is None:
+            version = caching.get_version(cls.version_cache_key(site_url))
+        # The shared copy is stamped with the version read before it was
+        # loaded, one stored by a worker that read an older version is
+        # loaded again.
+        cached = cache.get(cls.defaults_cache_key(site_url))
+        if cached is None or cached[0] != version:
+            cached = cls._cache_defaults(site, site_url, version)
+        _version, payload = cached
+        return MappingProxyType({
+            key: Default.create(site_url, kind, key, value, deprecated)
+            for key, (kind, value, deprecated) in payload.items()
+        })
+
+    @classmethod
+    def snapshot(cls, site_url: str) -> Tuple[int, bytes]:
+        """The site defaults encoded as JSON along with their version.
+
+        The snapshot is the same for every user so clients and CDNs can cache
+        it for as long as the version stays the same, and only fetch the
+        user's overrides.
+        """
+        return cls._cached(
+            'snapshot',
+            site_url,
+            lambda: cls._snapshot(site_url),
+        )
+
+    @classmethod
+    def _snapshot(cls, site_url: str) -> Tuple[int, bytes]:
+        # Read the version before the defaults, and skip the local cache as
+        # it may hold an older version of the defaults for a few seconds.
+        version = caching.get_version(cls.version_cache_key(site_url))
+        defaults = cls._defaults_by_key(site_url, version)
+        payload = encoders.dumps({
+            'data': {
+                'version': str(version),
+                'defaults': {
+                    key: {'kind': default.kind, 'value': default.parsed}
+                    for key, default in defaults.items()
+                    if not default.deprecated
+                },
+            },
+        })
+        return version, payload
+
+    @classmethod
+    def default_for_key(cls, site_url: str, key: str) -> Default:
         try:
-            default = Kind.objects.get(site=site, key=key)
-        except Kind.DoesNotExist:
+            default = cls.defaults_by_key(site_url)[key]
+        except KeyError:
             raise InvalidKey
 
+        if default.deprecated:
+            raise InvalidKey
         return default
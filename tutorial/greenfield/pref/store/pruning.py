@@ -0,0 +1,76 @@
+"""Background pruning of the overrides of deprecated kinds.
+
+Reads already skip deprecated kinds, so their overrides can be removed at
+leisure. Rather than one DELETE over every matching row, which would hold
+locks on the table for as long as it runs, the primary keys of a small
+batch are selected and deleted in their own transaction, with a pause
+between batches to let other writes through.
+"""
+import time
+from typing import Callable, Iterator, Optional, Tuple
+
+from django.db import transaction
+
+from .models import Change, Kind, Override
+
+PRUNE_BATCH_SIZE = 500
+
+# Seconds to wait between batches.
+PRUNE_PAUSE = 0.1
+
+
+def deprecated_kinds(site_url: Optional[str] = None) -> Iterator[Tuple[str, str]]:
+    """The `(site, key)` of every deprecated kind, or only those of one site."""
+    kinds = Kind.objects.filter(deprecated=True)
+    if site_url is not None:
+        kinds = kinds.filter(site__pk=site_url)
+    return iter(kinds.order_by('site', 'key').values_list('site', 'key'))
+
+
+def prune_batch(site_url: str, key: str, batch_size: int = PRUNE_BATCH_SIZE) -> int:
+    """Delete up to `batch_size` overrides of a deprecated kind."""
+    with transaction.atomic():
+        # Check in the same transaction, the kind may have been restored
+        # since the pruning started.
+        if not Kind.objects.filter(site__pk=site_url, key=key, deprecated=True).exists():
+            return 0
+        rows = list(
+            Override.objects.filter(site__pk=site_url, key=key)
+            .values_list('uuid', 'user_id')[:batch_size]
+        )
+        if not rows:
+            return 0
+        Override.objects.filter(uuid__in=[uuid for uuid, _user_id in rows]).delete()
+        Change.objects.bulk_create([
+            Change(**Change.for_reset(site_url, user_id, key)) for _uuid, user_id in rows
+        ])
+    # The cached preferences already leave out deprecated kinds, so nothing
+    # needs to be invalidated.
+    return len(rows)
+
+
+def prune_deprecated_overrides(
+    site_url: Optional[str] = None,
+    batch_size: int = PRUNE_BATCH_SIZE,
+    pause: float = PRUNE_PAUSE,
+    max_batches: Optional[int] = None,
+    sleep: Callable[[float], None] = time.sleep,
+) -> int:
+    """Delete the overrides of deprecated kinds in throttled batches.
+
+    Stops after `max_batches` so a run can be spread over several cron
+    invocations, and returns the number of overrides deleted.
+    """
+    deleted = 0
+    batches = 0
+    for site, key in deprecated_kinds(site_url):
+        while max_batches is None or batches < max_batches:
+            count = prune_batch(site, key, batch_size)
+            if not count:
+                break
+            deleted += count
+            batches += 1
+            if count < batch_size:
+                break
+            sleep(pause)
+    return deleted
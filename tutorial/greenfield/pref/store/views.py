@@ -1,9 +1,32 @@
 import json
+import uuid
 
 from django import http
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
 from django.views import View
 
-from .models import PreferenceController
+from . import encoders, exports
+from .models import (
+    IdentityError,
+    InvalidKey,
+    InvalidSite,
+    InvalidToken,
+    NotAllowed,
+    Preference,
+    PreferenceController,
+    SiteController,
+)
+
+
+def preference_to_dict(p: Preference) -> dict:
+    return {
+        'site_url': p.site_url,
+        'user_id': p.user_id,
+        'kind': p.kind,
+        'key': p.key,
+        'value': p.value,
+    }
 
 
 class PreferenceAPI(View):
@@ -31,71 +54,290 @@ class PreferenceAPI(View):
             status=status,
         )
 
-    def get_auth_token(self) -> str:
-        auth_token = self.request.META.get('HTTP_X_AUTH_TOKEN')
-        if auth_token is None:
+    def dispatch(self, request: http.HttpRequest, *args, **kwargs) -> http.HttpResponse:
+        try:
+            return super().dispatch(request, *args, **kwargs)
+        except InvalidToken as error:
             return self.respond_with_error(
-                error_message='Missing Auth Token',
+                error_message=str(error) or 'Invalid Auth Token',
                 status=403,
             )
+        except NotAllowed:
+            return self.respond_with_error(
+                error_message='Not allowed',
+                status=403,
+            )
+        except IdentityError:
+            return self.respond_with_error(
+                error_message='Unable to verify Auth Token',
+                status=503,
+            )
+        except InvalidSite:
+            return self.respond_with_error(
+                error_message='Unknown Site',
+                status=404,
+            )
+
+    def get_auth_token(self) -> str:
+        auth_token = self.request.META.get('HTTP_X_AUTH_TOKEN')
+        if auth_token is None:
+            raise InvalidToken('Missing Auth Token')
         return auth_token
 
+    def not_modified(self, etag: str) -> bool:
+        if_none_match = parse_etags(self.request.META.get('HTTP_IF_NONE_MATCH', ''))
+        return etag in if_none_match or '*' in if_none_match
+
     def get(self, request: http.HttpRequest, site: str) -> http.HttpResponse:
-        preferences = PreferenceController.get(
-            auth_token=self.get_auth_token(),
+        auth_token = self.get_auth_token()
+        # The ETag only needs the cached versions, so clients polling for
+        # changes are answered without loading or encoding the preferences.
+        etag = PreferenceController.etag(auth_token=auth_token, site_url=site)
+        if self.not_modified(etag):
+            response = http.HttpResponseNotModified()
+            response['ETag'] = etag
+            patch_vary_headers(response, ['X-Auth-Token'])
+            return response
+
+        payload = PreferenceController.get_payload(
+            auth_token=auth_token,
             site_url=site,
         )
-
-        preference_list = [
-            {
-                'site_url': p.site_url,
-                'user_id': p.user_id,
-                'kind': p.kind,
-                'key': p.key,
-                'value': p.value,
-            }
-            for p in preferences
-        ]
-
-        try:
-            response = json.dumps({
-                'data': {
-                    'preferences': preference_list
-                }
-            })
-        except json.decoder.JSONDecodeError:
-            return self.respond_with_error('Unable to serialize JSON')
-        return http.HttpResponse(
-            response,
+        response = http.HttpResponse(
+            b'{"data":{"preferences":' + payload + b'}}',
             content_type='application/json'
         )
+        response['ETag'] = etag
+        patch_vary_headers(response, ['X-Auth-Token'])
+        return response
 
     def post(self, request: http.HttpRequest, site: str) -> http.HttpResponse:
         key = None
         value = None
+        values = None
 
         try:
             data = json.loads(request.body)
             if not isinstance(data, dict):
                 return self.respond_with_error('Unable to parse body.')
 
-            key = data.get('key')
-            value = data.get('value')
+            # A batch of updates, ie `{"preferences": {"key": "value"}}`
+            if 'preferences' in data:
+                values = data['preferences']
+                if not isinstance(values, dict) or not values:
+                    return self.respond_with_error('Body preferences must be an object.')
+            else:
+                key = data.get('key')
+                value = data.get('value')
 
-            if key is None:
-                return self.respond_with_error('Body missing key attribute.')
+                if key is None:
+                    return self.respond_with_error('Body missing key attribute.')
 
-            if value is None:
-                return self.respond_with_error('Body missing value attribute.')
+                if value is None:
+                    return self.respond_with_error('Body missing value attribute.')
 
         except json.decoder.JSONDecodeError:
             return self.respond_with_error('Unable to parse JSON')
         except Exception:
             return self.respond_with_error()
 
+        # Outside of the `try` so token and site errors reach `dispatch`.
+        if values is not None:
+            return self.post_batch(site, values)
+
         PreferenceController.update(
             auth_token=self.get_auth_token(),
             site_url=site,
             key=key,
             value=value,
         )
+
+    def post_batch(self, site: str, values: dict) -> http.HttpResponse:
+        try:
+            preferences = PreferenceController.update_many(
+                auth_token=self.get_auth_token(),
+                site_url=site,
+                values=values,
+            )
+        except InvalidKey as error:
+            return self.respond_with_error(f'Invalid key {error}')
+        except ValueError as error:
+            return self.respond_with_error(str(error))
+
+        response = encoders.dumps({
+            'data': {
+                'preferences': [preference_to_dict(p) for p in preferences]
+            }
+        })
+        return http.HttpResponse(
+            response,
+            content_type='application/json'
+        )
+
+
+class BulkPreferenceAPI(PreferenceAPI):
+    """Fetch the preferences for many users of a site in one request.
+
+    The body is a JSON object like `{"user_ids": ["1", "2"]}` and the
+    response maps each user_id to their list of preferences. The token must
+    belong to one of the site's `PREF_SERVICE_USERS`.
+    """
+    http_method_names = ['post']
+
+    def post(self, request: http.HttpRequest, site: str) -> http.HttpResponse:
+        try:
+            data = json.loads(request.body)
+        except json.decoder.JSONDecodeError:
+            return self.respond_with_error('Unable to parse JSON')
+
+        if not isinstance(data, dict):
+            return self.respond_with_error('Unable to parse body.')
+
+        user_ids = data.get('user_ids')
+        if not isinstance(user_ids, list):
+            return self.respond_with_error('Body missing user_ids list.')
+
+        preferences = PreferenceController.get_many(
+            auth_token=self.get_auth_token(),
+            site_url=site,
+            user_ids=[str(user_id) for user_id in user_ids],
+        )
+
+        response = encoders.dumps({
+            'data': {
+                'preferences': {
+                    user_id: [preference_to_dict(p) for p in user_preferences]
+                    for user_id, user_preferences in preferences.items()
+                }
+            }
+        })
+        return http.HttpResponse(
+            response,
+            content_type='application/json'
+        )
+
+
+class SiteDefaultsAPI(PreferenceAPI):
+    """The defaults for every preference of a site.
+
+    The response is the same for every user and does not need a token. When
+    the `version` query parameter names the current version the response is
+    marked immutable, so clients and CDNs can keep it until the overrides
+    endpoint reports a new `defaults_version`.
+    """
+    http_method_names = ['get']
+
+    def get(self, request: http.HttpRequest, site: str) -> http.HttpResponse:
+        version, payload = SiteController.snapshot(site_url=site)
+        etag = f'"{version}"'
+        if self.not_modified(etag):
+            response = http.HttpResponseNotModified()
+        else:
+            response = http.HttpResponse(payload, content_type='application/json')
+        response['ETag'] = etag
+        if request.GET.get('version') == str(version):
+            response['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response['Cache-Control'] = 'public, no-cache'
+        return response
+
+
+class PreferenceOverridesAPI(PreferenceAPI):
+    """Only the preferences where the user differs from the site defaults.
+
+    Combined with the `SiteDefaultsAPI` snapshot for `defaults_version` this
+    is the full preference list, in a fraction of the size.
+    """
+    http_method_names = ['get']
+
+    def get(self, request: http.HttpRequest, site: str) -> http.HttpResponse:
+        auth_token = self.get_auth_token()
+        etag = PreferenceController.etag(auth_token=auth_token, site_url=site)
+        if self.not_modified(etag):
+            response = http.HttpResponseNotModified()
+        else:
+            version, overrides = PreferenceController.overrides(
+                auth_token=auth_token,
+                site_url=site,
+            )
+            etag = '"%s-%s"' % version
+            response = http.HttpResponse(
+                encoders.dumps({
+                    'data': {
+                        'defaults_version': str(version[0]),
+                        'version': etag.strip('"'),
+                        'overrides': overrides,
+                    }
+                }),
+                content_type='application/json'
+            )
+        response['ETag'] = etag
+        response['Cache-Control'] = 'private, no-cache'
+        patch_vary_headers(response, ['X-Auth-Token'])
+        return response
+
+
+class ChangesAPI(PreferenceAPI):
+    """The changes to a site's preferences after a cursor.
+
+    Consumers keep the `cursor` from each response and send it back as the
+    `since` parameter, when `has_more` is false they are caught up. Changes
+    are served a few seconds after they are made, so the cursor never moves
+    past a change that has not committed yet. The token must belong to one
+    of the site's `PREF_SERVICE_USERS`.
+    """
+    http_method_names = ['get']
+
+    def get(self, request: http.HttpRequest, site: str) -> http.HttpResponse:
+        try:
+            since = int(request.GET.get('since', 0))
+            limit = int(request.GET.get('limit', PreferenceController.CHANGES_PAGE_SIZE))
+        except ValueError:
+            return self.respond_with_error('since and limit must be integers.')
+        limit = max(1, min(limit, PreferenceController.CHANGES_PAGE_SIZE))
+
+        # Ask for one extra change to find out if there are more pages.
+        changes = PreferenceController.changes(
+            auth_token=self.get_auth_token(),
+            site_url=site,
+            since=since,
+            limit=limit + 1,
+        )
+        has_more = len(changes) > limit
+        changes = changes[:limit]
+        cursor = changes[-1].id if changes else since
+
+        response = encoders.dumps({
+            'data': {
+                'changes': [change.to_dict() for change in changes],
+                'cursor': str(cursor),
+                'has_more': has_more,
+            }
+        })
+        return http.HttpResponse(
+            response,
+            content_type='application/json'
+        )
+
+
+class ExportAPI(PreferenceAPI):
+    """Stream every override of the site as newline delimited JSON.
+
+    Send the `cursor` of the last line received as the `after` parameter to
+    resume an interrupted export. The token must belong to one of the site's
+    `PREF_SERVICE_USERS`.
+    """
+    http_method_names = ['get']
+
+    def get(self, request: http.HttpRequest, site: str) -> http.HttpResponse:
+        after = request.GET.get('after')
+        try:
+            after = uuid.UUID(after) if after else None
+        except ValueError:
+            return self.respond_with_error('after must be a cursor from a previous export.')
+
+        PreferenceController.get_service_user_id(site_url=site, token=self.get_auth_token())
+        return http.StreamingHttpResponse(
+            exports.iter_overrides(site, after=after),
+            content_type='application/x-ndjson',
+        )
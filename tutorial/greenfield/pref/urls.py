@@ -27,4 +27,29 @@ urlpatterns = [
         views.PreferenceAPI.as_view(),
         name='preference-collection'
     ),
+    path(
+        'api/v1/preference/<str:site>/bulk',
+        views.BulkPreferenceAPI.as_view(),
+        name='preference-bulk'
+    ),
+    path(
+        'api/v1/preference/<str:site>/defaults',
+        views.SiteDefaultsAPI.as_view(),
+        name='preference-defaults'
+    ),
+    path(
+        'api/v1/preference/<str:site>/overrides',
+        views.PreferenceOverridesAPI.as_view(),
+        name='preference-overrides'
+    ),
+    path(
+        'api/v1/preference/<str:site>/changes',
+        views.ChangesAPI.as_view(),
+        name='preference-changes'
+    ),
+    path(
+        'api/v1/preference/<str:site>/export',
+        views.ExportAPI.as_view(),
+        name='preference-export'
+    ),
 ]
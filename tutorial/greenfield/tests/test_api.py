@@ -1,11 +1,31 @@
+import importlib.util
+import json
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-from django.test import TestCase
+from django.core.cache import cache
+from django.db.models import F
+from django.test import TestCase, override_settings
 
 from pref.store import models
 
 
+# The user every token belongs to is also the site's service user.
+@override_settings(PREF_SERVICE_USERS={'example.com': ['identity.foo.com']})
 class PreferenceAPITests(TestCase):
 
+    def setUp(self):
+        cache.clear()
+        models.SiteController.local_cache.clear()
+        # These tests are not about authentication, every token belongs to
+        # a user named after the site's auth_url.
+        verify_token = mock.patch(
+            'pref.store.identity.verify_token',
+            side_effect=lambda auth_url, token: (auth_url, None),
+        )
+        verify_token.start()
+        self.addCleanup(verify_token.stop)
+
     def test_api_returns_json_preferences_list(self):
         site = models.Site.objects.create(
             url='example.com',
@@ -47,3 +67,548 @@ class PreferenceAPITests(TestCase):
         }
 
         self.assertEqual(resp.json(), expected)
+
+    def test_bulk_api_returns_preferences_by_user(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='INTEGER',
+            key='test-key',
+            deprecated=False,
+            value='1',
+        )
+        models.Override.objects.create(
+            site=site,
+            user_id='user-1',
+            kind='INTEGER',
+            key='test-key',
+            value='42',
+        )
+
+        resp = self.client.post(
+            '/api/v1/preference/example.com/bulk',
+            data={'user_ids': ['user-1', 'user-2']},
+            content_type='application/json',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+
+        self.assertEquals(resp.status_code, 200)
+
+        expected = {
+            'data': {
+                'preferences': {
+                    'user-1': [
+                        {
+                            'site_url': site.url,
+                            'kind': 'INTEGER',
+                            'user_id': 'user-1',
+                            'key': 'test-key',
+                            'value': 42
+                        }
+                    ],
+                    'user-2': [
+                        {
+                            'site_url': site.url,
+                            'kind': 'INTEGER',
+                            'user_id': 'user-2',
+                            'key': 'test-key',
+                            'value': 1
+                        }
+                    ],
+                }
+            }
+        }
+
+        self.assertEqual(resp.json(), expected)
+
+    @override_settings(PREF_SERVICE_USERS={})
+    def test_bulk_api_rejects_end_user_tokens(self):
+        models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+
+        resp = self.client.post(
+            '/api/v1/preference/example.com/bulk',
+            data={'user_ids': ['user-1']},
+            content_type='application/json',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+
+        self.assertEqual(resp.status_code, 403)
+
+    def test_bulk_api_requires_user_ids(self):
+        models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+
+        resp = self.client.post(
+            '/api/v1/preference/example.com/bulk',
+            data={},
+            content_type='application/json',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+
+        self.assertEquals(resp.status_code, 400)
+
+    def test_api_batch_post_updates_preferences(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='INTEGER',
+            key='test-key',
+            deprecated=False,
+            value='1',
+        )
+
+        resp = self.client.post(
+            '/api/v1/preference/example.com',
+            data={'preferences': {'test-key': '42'}},
+            content_type='application/json',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+
+        self.assertEquals(resp.status_code, 200)
+
+        expected = {
+            'data': {
+                'preferences': [
+                    {
+                        'site_url': site.url,
+                        'kind': 'INTEGER',
+                        'user_id': 'identity.foo.com',
+                        'key': 'test-key',
+                        'value': 42
+                    }
+                ]
+            }
+        }
+
+        self.assertEqual(resp.json(), expected)
+
+    def test_api_batch_post_rejects_unknown_key(self):
+        models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+
+        resp = self.client.post(
+            '/api/v1/preference/example.com',
+            data={'preferences': {'missing-key': '42'}},
+            content_type='application/json',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+
+        self.assertEquals(resp.status_code, 400)
+
+    def test_api_batch_post_rejects_missing_token(self):
+        models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+
+        resp = self.client.post(
+            '/api/v1/preference/example.com',
+            data={'preferences': {'test-key': '42'}},
+            content_type='application/json',
+        )
+
+        self.assertEquals(resp.status_code, 403)
+
+        with mock.patch('pref.store.identity.verify_token', side_effect=models.IdentityError):
+            resp = self.client.post(
+                '/api/v1/preference/example.com',
+                data={'preferences': {'test-key': '42'}},
+                content_type='application/json',
+                HTTP_X_AUTH_TOKEN='fake-token',
+            )
+
+        self.assertEquals(resp.status_code, 503)
+
+    def test_api_batch_post_rejects_unknown_site(self):
+        resp = self.client.post(
+            '/api/v1/preference/missing.com',
+            data={'preferences': {'test-key': '42'}},
+            content_type='application/json',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+
+        self.assertEquals(resp.status_code, 404)
+
+    def test_api_rejects_missing_and_invalid_tokens(self):
+        models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+
+        resp = self.client.get('/api/v1/preference/example.com')
+
+        self.assertEquals(resp.status_code, 403)
+
+        with mock.patch('pref.store.identity.verify_token', side_effect=models.InvalidToken):
+            resp = self.client.get(
+                '/api/v1/preference/example.com',
+                HTTP_X_AUTH_TOKEN='bad-token',
+            )
+
+        self.assertEquals(resp.status_code, 403)
+
+    def test_api_returns_not_modified_for_matching_etag(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='INTEGER',
+            key='test-key',
+            deprecated=False,
+            value='1',
+        )
+        resp = self.client.get(
+            '/api/v1/preference/example.com',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+        etag = resp['ETag']
+
+        with self.assertNumQueries(0):
+            resp = self.client.get(
+                '/api/v1/preference/example.com',
+                HTTP_X_AUTH_TOKEN='fake-token',
+                HTTP_IF_NONE_MATCH=etag,
+            )
+
+        self.assertEquals(resp.status_code, 304)
+        self.assertEquals(resp['ETag'], etag)
+
+        models.PreferenceController.update(
+            auth_token='fake-token',
+            site_url='example.com',
+            key='test-key',
+            value='42',
+        )
+        resp = self.client.get(
+            '/api/v1/preference/example.com',
+            HTTP_X_AUTH_TOKEN='fake-token',
+            HTTP_IF_NONE_MATCH=etag,
+        )
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertNotEqual(resp['ETag'], etag)
+        self.assertEqual(resp.json()['data']['preferences'][0]['value'], 42)
+
+    def test_api_etag_changes_when_site_defaults_change(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        kind = models.Kind.objects.create(
+            site=site,
+            kind='INTEGER',
+            key='test-key',
+            deprecated=False,
+            value='1',
+        )
+        resp = self.client.get(
+            '/api/v1/preference/example.com',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+        etag = resp['ETag']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            kind.value = '2'
+            kind.save()
+        resp = self.client.get(
+            '/api/v1/preference/example.com',
+            HTTP_X_AUTH_TOKEN='fake-token',
+            HTTP_IF_NONE_MATCH=etag,
+        )
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertEqual(resp.json()['data']['preferences'][0]['value'], 2)
+
+    def test_api_serves_cached_payload_without_encoding(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='INTEGER',
+            key='test-key',
+            deprecated=False,
+            value='1',
+        )
+        first = self.client.get(
+            '/api/v1/preference/example.com',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+
+        with mock.patch('pref.store.encoders.json_dumps') as json_dumps:
+            with self.assertNumQueries(0):
+                second = self.client.get(
+                    '/api/v1/preference/example.com',
+                    HTTP_X_AUTH_TOKEN='fake-token',
+                )
+
+        json_dumps.assert_not_called()
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second.json()['data']['preferences'][0]['value'], 1)
+
+    @skipUnless(importlib.util.find_spec('orjson'), 'orjson is not installed')
+    @override_settings(PREF_JSON_ENCODER='pref.store.encoders.orjson_dumps')
+    def test_api_uses_configured_encoder(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='OBJECT',
+            key='test-key',
+            deprecated=False,
+            value='{"a": [1, 2]}',
+        )
+
+        resp = self.client.get(
+            '/api/v1/preference/example.com',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+
+        self.assertEqual(resp.json()['data']['preferences'][0]['value'], {'a': [1, 2]})
+
+    def test_api_defaults_snapshot_and_overrides_diff(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='INTEGER',
+            key='first-key',
+            deprecated=False,
+            value='1',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='second-key',
+            deprecated=False,
+            value='default',
+        )
+        models.PreferenceController.update(
+            auth_token='fake-token',
+            site_url='example.com',
+            key='first-key',
+            value='42',
+        )
+
+        resp = self.client.get('/api/v1/preference/example.com/overrides')
+
+        self.assertEquals(resp.status_code, 403)
+
+        resp = self.client.get(
+            '/api/v1/preference/example.com/overrides',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+        overrides = resp.json()['data']
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertEqual(overrides['overrides'], {'first-key': 42})
+
+        resp = self.client.get(
+            '/api/v1/preference/example.com/defaults',
+            {'version': overrides['defaults_version']},
+        )
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertIn('immutable', resp['Cache-Control'])
+        self.assertEqual(resp.json(), {
+            'data': {
+                'version': overrides['defaults_version'],
+                'defaults': {
+                    'first-key': {'kind': 'INTEGER', 'value': 1},
+                    'second-key': {'kind': 'STRING', 'value': 'default'},
+                },
+            },
+        })
+
+        resp = self.client.get(
+            '/api/v1/preference/example.com/overrides',
+            HTTP_X_AUTH_TOKEN='fake-token',
+            HTTP_IF_NONE_MATCH=f'"{overrides["version"]}"',
+        )
+
+        self.assertEquals(resp.status_code, 304)
+
+    def test_api_defaults_snapshot_changes_with_kinds(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        kind = models.Kind.objects.create(
+            site=site,
+            kind='INTEGER',
+            key='test-key',
+            deprecated=False,
+            value='1',
+        )
+        resp = self.client.get('/api/v1/preference/example.com/defaults')
+        etag = resp['ETag']
+
+        self.assertEqual(resp['Cache-Control'], 'public, no-cache')
+
+        resp = self.client.get('/api/v1/preference/example.com/defaults', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEquals(resp.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            kind.value = '2'
+            kind.save()
+        resp = self.client.get('/api/v1/preference/example.com/defaults', HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertEqual(resp.json()['data']['defaults']['test-key']['value'], 2)
+
+    def test_api_defaults_snapshot_for_unknown_site(self):
+        resp = self.client.get('/api/v1/preference/missing.com/defaults')
+
+        self.assertEquals(resp.status_code, 404)
+        # Unknown urls must not leave keys in the cache behind.
+        self.assertIsNone(cache.get(models.SiteController.version_cache_key('missing.com')))
+
+        resp = self.client.get(
+            '/api/v1/preference/missing.com',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+
+        self.assertEquals(resp.status_code, 404)
+        self.assertIsNone(cache.get(models.SiteController.version_cache_key('missing.com')))
+
+    def test_api_changes_are_paged_by_cursor(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='INTEGER',
+            key='test-key',
+            deprecated=False,
+            value='1',
+        )
+        for value in ('2', '3'):
+            models.PreferenceController.update(
+                auth_token='fake-token',
+                site_url='example.com',
+                key='test-key',
+                value=value,
+            )
+        # Recent changes are held back, these have settled.
+        models.Change.objects.update(created=F('created') - timedelta(minutes=1))
+
+        resp = self.client.get(
+            '/api/v1/preference/example.com/changes',
+            {'limit': 2},
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+        data = resp.json()['data']
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertTrue(data['has_more'])
+        self.assertEqual([c['value'] for c in data['changes']], [1, 2])
+
+        resp = self.client.get(
+            '/api/v1/preference/example.com/changes',
+            {'since': data['cursor']},
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+        data = resp.json()['data']
+
+        self.assertFalse(data['has_more'])
+        self.assertEqual(len(data['changes']), 1)
+        self.assertEqual(data['changes'][0]['action'], 'set')
+        self.assertEqual(data['changes'][0]['user_id'], 'identity.foo.com')
+        self.assertEqual(data['changes'][0]['value'], 3)
+
+        resp = self.client.get(
+            '/api/v1/preference/example.com/changes',
+            {'since': data['cursor']},
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+
+        self.assertEqual(resp.json()['data']['changes'], [])
+        self.assertEqual(resp.json()['data']['cursor'], data['cursor'])
+
+    @override_settings(PREF_SERVICE_USERS={})
+    def test_api_changes_reject_end_user_tokens(self):
+        models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+
+        resp = self.client.get(
+            '/api/v1/preference/example.com/changes',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+
+        self.assertEqual(resp.status_code, 403)
+
+    def test_api_export_streams_ndjson(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='INTEGER',
+            key='test-key',
+            deprecated=False,
+            value='1',
+        )
+        models.PreferenceController.update(
+            auth_token='fake-token',
+            site_url='example.com',
+            key='test-key',
+            value='42',
+        )
+
+        resp = self.client.get(
+            '/api/v1/preference/example.com/export',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+        lines = b''.join(resp.streaming_content).splitlines()
+
+        self.assertEquals(resp.status_code, 200)
+        self.assertEqual(resp['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['value'], 42)
+
+        resp = self.client.get(
+            '/api/v1/preference/example.com/export',
+            {'after': json.loads(lines[0])['cursor']},
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+
+        self.assertEqual(b''.join(resp.streaming_content), b'')
+
+    @override_settings(PREF_SERVICE_USERS={})
+    def test_api_export_rejects_end_user_tokens(self):
+        models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+
+        resp = self.client.get(
+            '/api/v1/preference/example.com/export',
+            HTTP_X_AUTH_TOKEN='fake-token',
+        )
+
+        self.assertEqual(resp.status_code, 403)
@@ -0,0 +1,51 @@
+import json
+from io import StringIO
+
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+
+from pref.store import models
+
+
+class ExportOverridesCommandTest(TestCase):
+
+    def setUp(self):
+        models.SiteController.local_cache.clear()
+        self.site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        for user in range(5):
+            models.Override.objects.create(
+                site=self.site,
+                user_id=f'user-{user}',
+                kind='OBJECT',
+                key='test-key',
+                value=json.dumps({'user': user}),
+            )
+
+    def export(self, *args, **kwargs):
+        out = StringIO()
+        call_command('export_overrides', *args, stdout=out, **kwargs)
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_exports_every_override(self):
+        actual = self.export('example.com', chunk_size=2)
+
+        self.assertEqual(len(actual), 5)
+        self.assertEqual(
+            sorted(row['value']['user'] for row in actual),
+            [0, 1, 2, 3, 4],
+        )
+        self.assertEqual([row['cursor'] for row in actual], sorted(row['cursor'] for row in actual))
+
+    def test_export_resumes_after_cursor(self):
+        everything = self.export('example.com')
+
+        actual = self.export('example.com', after=everything[1]['cursor'])
+
+        self.assertEqual(actual, everything[2:])
+
+    def test_export_of_unknown_site_fails(self):
+        with self.assertRaises(CommandError):
+            self.export('missing.com')
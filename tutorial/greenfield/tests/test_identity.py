@@ -0,0 +1,128 @@
+import datetime
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from pref.store import identity
+
+
+class FakeIdentityService:
+    """A local identity service that knows about a few tokens."""
+
+    def __init__(self):
+        self.tokens = {}
+        self.calls = 0
+        self.delay = 0
+        self.status = None
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                service.calls += 1
+                time.sleep(service.delay)
+                token = service.tokens.get(self.headers.get('X-Auth-Token'))
+                if service.status is not None:
+                    self.send_response(service.status)
+                    self.end_headers()
+                elif token is None:
+                    self.send_response(401)
+                    self.end_headers()
+                else:
+                    body = json.dumps(token).encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/v1/tokens'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TokenCacheTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.service = FakeIdentityService()
+        self.service.start()
+        self.addCleanup(self.service.stop)
+        self.token_cache = identity.TokenCache(ttl=300, negative_ttl=30)
+
+    def test_valid_token_is_verified_once(self):
+        self.service.tokens['good-token'] = {'user_id': 'user-1'}
+
+        for _ in range(3):
+            actual = self.token_cache.get_user_id(self.service.url, 'good-token')
+            self.assertEqual(actual, 'user-1')
+
+        self.assertEqual(self.service.calls, 1)
+
+    def test_rejected_token_is_negatively_cached(self):
+        for _ in range(3):
+            with self.assertRaises(identity.InvalidToken):
+                self.token_cache.get_user_id(self.service.url, 'bad-token')
+
+        self.assertEqual(self.service.calls, 1)
+
+    def test_cache_ttl_is_bounded_by_token_expiry(self):
+        expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=60)
+        self.service.tokens['good-token'] = {
+            'user_id': 'user-1',
+            'expires_at': expires.isoformat(),
+        }
+
+        with mock.patch.object(identity.cache, 'set', wraps=cache.set) as cache_set:
+            self.token_cache.get_user_id(self.service.url, 'good-token')
+
+        _key, user_id, ttl = cache_set.call_args[0]
+        self.assertEqual(user_id, 'user-1')
+        self.assertTrue(0 < ttl <= 60)
+
+    def test_tokens_are_hashed_in_cache_keys(self):
+        key = self.token_cache.cache_key(self.service.url, 'secret-token')
+
+        self.assertNotIn('secret-token', key)
+        self.assertNotEqual(key, self.token_cache.cache_key('http://other', 'secret-token'))
+
+    def test_concurrent_requests_share_one_identity_call(self):
+        self.service.tokens['good-token'] = {'user_id': 'user-1'}
+        self.service.delay = 0.2
+        results = []
+
+        def verify():
+            results.append(self.token_cache.get_user_id(self.service.url, 'good-token'))
+
+        threads = [threading.Thread(target=verify) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results, ['user-1'] * 5)
+        self.assertEqual(self.service.calls, 1)
+
+    def test_identity_errors_are_not_cached(self):
+        self.service.status = 500
+
+        for _ in range(2):
+            with self.assertRaises(identity.IdentityError):
+                self.token_cache.get_user_id(self.service.url, 'good-token')
+
+        self.assertEqual(self.service.calls, 2)
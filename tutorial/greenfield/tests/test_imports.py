@@ -0,0 +1,189 @@
+import io
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+
+from pref.store import imports, models
+
+KINDS_CSV = """key,kind,value,deprecated
+color,STRING,blue,false
+count,INTEGER,1,false
+layout,OBJECT,"{""columns"": 2}",false
+broken,INTEGER,not-a-number,false
+"""
+
+OVERRIDES_NDJSON = """{"user_id": "user-1", "key": "count", "value": 5}
+{"user_id": "user-1", "key": "layout", "value": {"columns": 3}}
+{"user_id": "user-2", "key": "color", "value": "red"}
+{"user_id": "user-2", "key": "count", "value": "many"}
+{"user_id": "user-3", "key": "missing", "value": 1}
+"""
+
+
+class ImportTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        models.SiteController.local_cache.clear()
+        verify_token = mock.patch(
+            'pref.store.identity.verify_token',
+            side_effect=lambda auth_url, token: ('user-1', None),
+        )
+        verify_token.start()
+        self.addCleanup(verify_token.stop)
+        self.site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+
+    def test_import_kinds_from_csv(self):
+        report = imports.import_kinds(
+            'example.com',
+            imports.read_rows(io.StringIO(KINDS_CSV), 'csv'),
+            raw=True,
+            batch_size=2,
+        )
+
+        self.assertEqual((report.rows, report.written, report.invalid), (4, 3, 1))
+        self.assertEqual(report.errors, [(4, 'expected INTEGER for key broken')])
+        self.assertEqual(
+            sorted(models.Kind.objects.values_list('key', 'value')),
+            [('color', 'blue'), ('count', '1'), ('layout', '{"columns": 2}')],
+        )
+
+    def test_import_overrides_from_ndjson(self):
+        imports.import_kinds('example.com', imports.read_rows(io.StringIO(KINDS_CSV), 'csv'), raw=True)
+        # Warm the cache so we can see the import invalidate it.
+        models.PreferenceController.get(auth_token='fake-token', site_url='example.com')
+
+        report = imports.import_overrides(
+            'example.com',
+            imports.read_rows(io.StringIO(OVERRIDES_NDJSON), 'ndjson'),
+            batch_size=2,
+        )
+
+        self.assertEqual((report.rows, report.written, report.invalid), (5, 3, 2))
+        self.assertEqual(
+            sorted(models.Override.objects.values_list('user_id', 'key', 'value')),
+            [
+                ('user-1', 'count', '5'),
+                ('user-1', 'layout', '{"columns": 3}'),
+                ('user-2', 'color', 'red'),
+            ],
+        )
+        preferences = models.PreferenceController.get(auth_token='fake-token', site_url='example.com')
+        self.assertEqual(
+            {p.key: p.value for p in preferences},
+            {'color': 'blue', 'count': 5, 'layout': {'columns': 3}},
+        )
+
+    def test_import_replaces_and_resets_existing_overrides(self):
+        imports.import_kinds('example.com', imports.read_rows(io.StringIO(KINDS_CSV), 'csv'), raw=True)
+        imports.import_overrides('example.com', [
+            {'user_id': 'user-1', 'key': 'count', 'value': 5},
+            {'user_id': 'user-1', 'key': 'color', 'value': 'red'},
+        ])
+
+        report = imports.import_overrides('example.com', [
+            {'user_id': 'user-1', 'key': 'count', 'value': 7},
+            {'user_id': 'user-1', 'key': 'color', 'value': 'blue'},
+        ])
+
+        self.assertEqual((report.written, report.reset), (1, 1))
+        self.assertEqual(
+            list(models.Override.objects.values_list('key', 'value')),
+            [('count', '7')],
+        )
+
+    def test_import_reports_rows_missing_a_value(self):
+        report = imports.import_kinds(
+            'example.com',
+            imports.read_rows(io.StringIO(
+                'key,kind,value,deprecated\n'
+                'dark,BOOLEAN,true,false\n'
+                'color,STRING\n'
+                'compact,BOOLEAN\n'
+            ), 'csv'),
+            raw=True,
+        )
+
+        self.assertEqual(report.errors, [
+            (2, 'missing value for key color'),
+            (3, 'missing value for key compact'),
+        ])
+        self.assertEqual(list(models.Kind.objects.values_list('key', 'value')), [('dark', 'True')])
+
+        report = imports.import_overrides('example.com', [
+            {'user_id': 'user-1', 'key': 'dark'},
+            {'user_id': 'user-1', 'key': 'dark', 'value': None},
+        ])
+
+        self.assertEqual((report.written, report.invalid), (0, 2))
+        self.assertFalse(models.Override.objects.exists())
+
+    def test_import_rejects_unknown_boolean_spellings(self):
+        report = imports.import_kinds(
+            'example.com',
+            imports.read_rows(io.StringIO(
+                'key,kind,value,deprecated\n'
+                'dark,BOOLEAN,Off,false\n'
+                'compact,BOOLEAN,banana,false\n'
+            ), 'csv'),
+            raw=True,
+        )
+
+        self.assertEqual(report.errors, [(2, 'expected BOOLEAN for key compact')])
+
+        report = imports.import_overrides('example.com', [
+            {'user_id': 'user-1', 'key': 'dark', 'value': 'banana'},
+            {'user_id': 'user-2', 'key': 'dark', 'value': True},
+        ])
+
+        self.assertEqual(report.errors, [(1, 'expected BOOLEAN for key dark')])
+        self.assertEqual(
+            list(models.Override.objects.values_list('user_id', 'value')),
+            [('user-2', 'True')],
+        )
+
+    def test_import_reports_malformed_ndjson_lines(self):
+        imports.import_kinds('example.com', imports.read_rows(io.StringIO(KINDS_CSV), 'csv'), raw=True)
+
+        report = imports.import_overrides(
+            'example.com',
+            imports.read_rows(io.StringIO(
+                '{"user_id": "user-1", "key": "count", "value": 5}\n'
+                '{"user_id": "user-1", "key": \n'
+                '["user-2", "count", 6]\n'
+                '{"user_id": "user-2", "key": "count", "value": 7}\n'
+            ), 'ndjson'),
+            batch_size=2,
+        )
+
+        self.assertEqual((report.rows, report.written, report.invalid), (4, 2, 2))
+        self.assertEqual(report.errors[0][0], 2)
+        self.assertTrue(report.errors[0][1].startswith('invalid JSON'))
+        self.assertEqual(report.errors[1], (3, 'expected a JSON object'))
+
+    def test_import_command_reports_throughput(self):
+        path = self.tmp_file('kinds.csv', KINDS_CSV)
+        out = io.StringIO()
+        err = io.StringIO()
+
+        call_command('import_preferences', 'example.com', 'kinds', path, stdout=out, stderr=err)
+
+        self.assertIn('4 rows: 3 written, 0 reset to default, 1 invalid', out.getvalue())
+        self.assertIn('rows/s', out.getvalue())
+        self.assertIn('row 4: expected INTEGER for key broken', err.getvalue())
+
+    def tmp_file(self, name, content):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, name)
+        with open(path, 'w') as tmp:
+            tmp.write(content)
+        return path
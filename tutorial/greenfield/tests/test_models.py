@@ -1,10 +1,31 @@
-from django.test import TestCase
+import json
+import time
+from datetime import timedelta
+from unittest import mock
+
+from django.core.cache import cache
+from django.db.models import F
+from django.test import TestCase, override_settings
 
 from pref.store import models
 
 
+# The user every token belongs to is also the site's service user.
+@override_settings(PREF_SERVICE_USERS={'example.com': ['identity.foo.com']})
 class PreferenceControllerTest(TestCase):
 
+    def setUp(self):
+        cache.clear()
+        models.SiteController.local_cache.clear()
+        # These tests are not about authentication, every token belongs to
+        # a user named after the site's auth_url.
+        verify_token = mock.patch(
+            'pref.store.identity.verify_token',
+            side_effect=lambda auth_url, token: (auth_url, None),
+        )
+        verify_token.start()
+        self.addCleanup(verify_token.stop)
+
     def test_update_returns_new_preference(self):
         site = models.Site.objects.create(
             url='example.com',
@@ -110,3 +131,716 @@ class PreferenceControllerTest(TestCase):
             count_after_reset_to_default,
             count_before_initial_update
         )
+
+    def test_get_many_returns_preferences_for_each_user(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='test-key',
+            deprecated=False,
+            value='test-default',
+        )
+        models.Override.objects.create(
+            site=site,
+            user_id='user-1',
+            kind='STRING',
+            key='test-key',
+            value='custom_value',
+        )
+
+        actual = models.PreferenceController.get_many(
+            auth_token='fake-token',
+            site_url=site.url,
+            user_ids=['user-1', 'user-2'],
+        )
+
+        expected = {
+            'user-1': [
+                models.Preference(
+                    site_url='example.com',
+                    user_id='user-1',
+                    kind='STRING',
+                    key='test-key',
+                    value='custom_value',
+                ),
+            ],
+            'user-2': [
+                models.Preference(
+                    site_url='example.com',
+                    user_id='user-2',
+                    kind='STRING',
+                    key='test-key',
+                    value='test-default',
+                ),
+            ],
+        }
+
+        self.assertEqual(actual, expected)
+
+    @override_settings(PREF_SERVICE_USERS={'example.com': ['someone-else']})
+    def test_get_many_requires_a_service_user(self):
+        models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+
+        with self.assertRaises(models.NotAllowed):
+            models.PreferenceController.get_many(
+                auth_token='fake-token',
+                site_url='example.com',
+                user_ids=['user-1'],
+            )
+
+    def test_get_many_uses_one_override_query_and_caches_results(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='test-key',
+            deprecated=False,
+            value='test-default',
+        )
+        user_ids = [f'user-{i}' for i in range(20)]
+        # Warm the site caches so we only count the override queries.
+        models.SiteController.defaults(site_url=site.url)
+
+        with self.assertNumQueries(1):
+            models.PreferenceController.get_many(
+                auth_token='fake-token',
+                site_url=site.url,
+                user_ids=user_ids,
+            )
+
+        with self.assertNumQueries(0):
+            actual = models.PreferenceController.get_many(
+                auth_token='fake-token',
+                site_url=site.url,
+                user_ids=user_ids,
+            )
+
+        self.assertEqual(sorted(actual), sorted(user_ids))
+
+    def test_get_many_creates_missing_versions_in_bulk(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        user_ids = [f'user-{i}' for i in range(100)]
+        # Warm the site and token caches so only the per user calls are left.
+        models.PreferenceController.get_many(
+            auth_token='fake-token',
+            site_url=site.url,
+            user_ids=['user-warm'],
+        )
+
+        counted = mock.Mock(wraps=cache)
+        with mock.patch('pref.store.models.cache', counted), \
+                mock.patch('pref.store.caching.cache', counted):
+            models.PreferenceController.get_many(
+                auth_token='fake-token',
+                site_url=site.url,
+                user_ids=user_ids,
+            )
+
+        # One read of the cached lists, then one write and one read of the
+        # new versions, and one write of the lists.
+        self.assertEqual(
+            [name for name, _args, _kwargs in counted.method_calls],
+            ['get_many', 'set_many', 'get_many', 'set_many'],
+        )
+        versions = cache.get_many(
+            [models.PreferenceController.version_cache_key(site.url, user_id) for user_id in user_ids])
+        self.assertEqual(len(versions), 100)
+
+    def test_update_many_creates_and_removes_overrides(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='first-key',
+            deprecated=False,
+            value='first-default',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='INTEGER',
+            key='second-key',
+            deprecated=False,
+            value='1',
+        )
+        models.PreferenceController.update(
+            auth_token='fake-token',
+            site_url='example.com',
+            key='second-key',
+            value='42',
+        )
+
+        actual = models.PreferenceController.update_many(
+            auth_token='fake-token',
+            site_url='example.com',
+            values={'first-key': 'custom_value', 'second-key': '1'},
+        )
+
+        expected = [
+            models.Preference(
+                site_url='example.com',
+                user_id='identity.foo.com',
+                kind='STRING',
+                key='first-key',
+                value='custom_value',
+            ),
+            models.Preference(
+                site_url='example.com',
+                user_id='identity.foo.com',
+                kind='INTEGER',
+                key='second-key',
+                value=1,
+            ),
+        ]
+
+        self.assertEqual(actual, expected)
+        self.assertEqual(
+            list(models.Override.objects.values_list('key', 'value')),
+            [('first-key', 'custom_value')],
+        )
+
+    def test_update_many_rejects_unknown_keys_without_writing(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='test-key',
+            deprecated=False,
+            value='test-default',
+        )
+
+        with self.assertRaises(models.InvalidKey):
+            models.PreferenceController.update_many(
+                auth_token='fake-token',
+                site_url='example.com',
+                values={'test-key': 'custom_value', 'missing-key': 'value'},
+            )
+
+        self.assertEqual(models.Override.objects.count(), 0)
+
+    def test_update_patches_cached_preferences(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='test-key',
+            deprecated=False,
+            value='test-default',
+        )
+        models.PreferenceController.get(auth_token='fake-token', site_url='example.com')
+
+        models.PreferenceController.update(
+            auth_token='fake-token',
+            site_url='example.com',
+            key='test-key',
+            value='custom_value',
+        )
+        with self.assertNumQueries(0):
+            actual = models.PreferenceController.get(
+                auth_token='fake-token',
+                site_url='example.com',
+            )
+        self.assertEqual([p.value for p in actual], ['custom_value'])
+
+        models.PreferenceController.update(
+            auth_token='fake-token',
+            site_url='example.com',
+            key='test-key',
+            value='test-default',
+        )
+        with self.assertNumQueries(0):
+            actual = models.PreferenceController.get(
+                auth_token='fake-token',
+                site_url='example.com',
+            )
+        self.assertEqual([p.value for p in actual], ['test-default'])
+
+    def test_concurrent_write_rebuilds_cached_preferences(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='test-key',
+            deprecated=False,
+            value='test-default',
+        )
+        models.PreferenceController.get(auth_token='fake-token', site_url='example.com')
+
+        # Another writer, ie the django admin, changes the overrides between
+        # our read and our write so the cached list can not be patched.
+        with self.captureOnCommitCallbacks(execute=True):
+            models.Override.objects.create(
+                site=site,
+                user_id='identity.foo.com',
+                kind='STRING',
+                key='test-key',
+                value='admin_value',
+            )
+        models.PreferenceController.update(
+            auth_token='fake-token',
+            site_url='example.com',
+            key='test-key',
+            value='custom_value',
+        )
+
+        with self.assertNumQueries(1):
+            actual = models.PreferenceController.get(
+                auth_token='fake-token',
+                site_url='example.com',
+            )
+        self.assertEqual([p.value for p in actual], ['custom_value'])
+
+    def test_lists_are_built_from_defaults_at_their_site_version(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='test-key',
+            deprecated=False,
+            value='test-default',
+        )
+        self.assertEqual(
+            models.PreferenceController.get('fake-token', 'example.com')[0].value,
+            'test-default',
+        )
+
+        # Another worker saves the kind, this process still holds the old
+        # defaults for up to ttl seconds.
+        models.Kind.objects.filter(site=site).update(value='new-default')
+        cache.delete(models.SiteController.defaults_cache_key(site.url))
+        models.caching.bump_version(models.SiteController.version_cache_key(site.url))
+        etag = models.PreferenceController.etag('fake-token', 'example.com')
+
+        actual = models.PreferenceController.get('fake-token', 'example.com')
+        self.assertEqual(actual[0].value, 'new-default')
+        payload = models.PreferenceController.get_payload('fake-token', 'example.com')
+        self.assertIn(b'new-default', payload)
+        self.assertEqual(models.PreferenceController.etag('fake-token', 'example.com'), etag)
+        bulk = models.PreferenceController.get_many(
+            'fake-token', 'example.com', ['identity.foo.com', 'user-2'])
+        self.assertEqual(bulk['user-2'][0].value, 'new-default')
+
+        # What was cached under the new version is still right once the
+        # in process copy expires.
+        models.SiteController.local_cache.clear()
+        actual = models.PreferenceController.get('fake-token', 'example.com')
+        self.assertEqual(actual[0].value, 'new-default')
+
+    def test_override_writes_bump_the_version_after_commit(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        version = models.PreferenceController.version('example.com', 'identity.foo.com')
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            models.Override.objects.create(
+                site=site,
+                user_id='identity.foo.com',
+                kind='STRING',
+                key='test-key',
+                value='admin_value',
+            )
+            # A reader before the commit still sees the old rows, so it
+            # must not see the new version either.
+            self.assertEqual(
+                models.PreferenceController.version('example.com', 'identity.foo.com'),
+                version,
+            )
+
+        for callback in callbacks:
+            callback()
+        self.assertGreater(
+            models.PreferenceController.version('example.com', 'identity.foo.com'),
+            version,
+        )
+
+    def test_writes_are_recorded_in_the_change_log(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='INTEGER',
+            key='test-key',
+            deprecated=False,
+            value='1',
+        )
+        models.PreferenceController.update(
+            auth_token='fake-token',
+            site_url='example.com',
+            key='test-key',
+            value='42',
+        )
+        models.PreferenceController.update_many(
+            auth_token='fake-token',
+            site_url='example.com',
+            values={'test-key': '1'},
+        )
+        # Recent changes are held back, these have settled.
+        models.Change.objects.update(created=F('created') - timedelta(minutes=1))
+
+        changes = models.PreferenceController.changes(
+            auth_token='fake-token',
+            site_url='example.com',
+        )
+
+        self.assertEqual(
+            [(c.action, c.user_id, c.key, c.value) for c in changes],
+            [
+                (models.Change.DEFAULT_SET, '', 'test-key', '1'),
+                (models.Change.OVERRIDE_SET, 'identity.foo.com', 'test-key', '42'),
+                (models.Change.OVERRIDE_RESET, 'identity.foo.com', 'test-key', None),
+            ],
+        )
+
+        later = models.PreferenceController.changes(
+            auth_token='fake-token',
+            site_url='example.com',
+            since=changes[1].id,
+        )
+
+        self.assertEqual(later, changes[2:])
+
+    def test_recent_changes_are_held_back(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        kind = models.Kind.objects.create(
+            site=site,
+            kind='INTEGER',
+            key='test-key',
+            deprecated=False,
+            value='1',
+        )
+        models.Change.objects.update(created=F('created') - timedelta(minutes=1))
+        kind.deprecated = True
+        kind.save()
+        # A settled change after a recent one must wait for it, otherwise
+        # the cursor would move past the recent change.
+        models.Change.objects.create(
+            site=site,
+            key='other-key',
+            action=models.Change.DEFAULT_DELETE,
+        )
+        models.Change.objects.filter(key='other-key').update(
+            created=F('created') - timedelta(minutes=1))
+
+        changes = models.PreferenceController.changes(
+            auth_token='fake-token',
+            site_url='example.com',
+        )
+
+        self.assertEqual([(c.key, c.deprecated) for c in changes], [('test-key', False)])
+
+        models.Change.objects.update(created=F('created') - timedelta(minutes=1))
+        changes = models.PreferenceController.changes(
+            auth_token='fake-token',
+            site_url='example.com',
+            since=changes[0].id,
+        )
+
+        self.assertEqual(
+            [(c.action, c.key, c.deprecated) for c in changes],
+            [
+                (models.Change.DEFAULT_SET, 'test-key', True),
+                (models.Change.DEFAULT_DELETE, 'other-key', False),
+            ],
+        )
+
+    def test_deprecated_kinds_are_skipped_on_read(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='test-key',
+            deprecated=False,
+            value='test-default',
+        )
+        old = models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='old-key',
+            deprecated=False,
+            value='old-default',
+        )
+        models.PreferenceController.update(
+            auth_token='fake-token',
+            site_url='example.com',
+            key='old-key',
+            value='custom_value',
+        )
+        self.assertEqual(len(models.PreferenceController.get('fake-token', 'example.com')), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            old.deprecated = True
+            old.save()
+
+        expected = [
+            models.Preference('example.com', 'identity.foo.com', 'STRING', 'test-key', 'test-default'),
+        ]
+        self.assertEqual(models.PreferenceController.get('fake-token', 'example.com'), expected)
+        cache.clear()
+        self.assertEqual(
+            models.PreferenceController.get_many('fake-token', 'example.com', ['identity.foo.com']),
+            {'identity.foo.com': expected},
+        )
+        # The override is only hidden, it is pruned in the background.
+        self.assertTrue(models.Override.objects.filter(key='old-key').exists())
+        with self.assertRaises(models.InvalidKey):
+            models.PreferenceController.update(
+                auth_token='fake-token',
+                site_url='example.com',
+                key='old-key',
+                value='other_value',
+            )
+
+
+# The user every token belongs to is also the site's service user.
+@override_settings(PREF_SERVICE_USERS={'example.com': ['identity.foo.com']})
+class SiteControllerTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        models.SiteController.local_cache.clear()
+        # These tests are not about authentication, every token belongs to
+        # a user named after the site's auth_url.
+        verify_token = mock.patch(
+            'pref.store.identity.verify_token',
+            side_effect=lambda auth_url, token: (auth_url, None),
+        )
+        verify_token.start()
+        self.addCleanup(verify_token.stop)
+
+    def test_default_for_key_uses_cached_index(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='test-key',
+            deprecated=False,
+            value='test-default',
+        )
+        models.SiteController.defaults(site_url=site.url)
+
+        with self.assertNumQueries(0):
+            actual = models.SiteController.default_for_key(
+                site_url=site.url,
+                key='test-key',
+            )
+
+        self.assertEqual(actual.value, 'test-default')
+
+    def test_default_for_key_index_is_cleared_when_kind_is_saved(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        kind = models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='test-key',
+            deprecated=False,
+            value='test-default',
+        )
+        models.SiteController.default_for_key(site_url=site.url, key='test-key')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            kind.value = 'new-default'
+            kind.save()
+
+        actual = models.SiteController.default_for_key(
+            site_url=site.url,
+            key='test-key',
+        )
+
+        self.assertEqual(actual.value, 'new-default')
+
+    def test_defaults_are_cached_as_plain_mapping(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='OBJECT',
+            key='test-key',
+            deprecated=False,
+            value='{"a": [1, 2]}',
+        )
+
+        actual = models.SiteController.defaults(site_url=site.url)
+
+        self.assertEqual(
+            cache.get(models.SiteController.defaults_cache_key(site.url)),
+            (
+                cache.get(models.SiteController.version_cache_key(site.url)),
+                {'test-key': ('OBJECT', '{"a": [1, 2]}', False)},
+            ),
+        )
+        self.assertEqual(
+            actual,
+            [models.Default.create('example.com', 'OBJECT', 'test-key', '{"a": [1, 2]}', False)],
+        )
+        self.assertEqual(actual[0].to_preference('user').value, {'a': [1, 2]})
+
+    def test_hot_reads_are_served_in_process(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='test-key',
+            deprecated=False,
+            value='test-default',
+        )
+        models.SiteController.defaults(site_url=site.url)
+        models.SiteController.auth_url(site_url=site.url)
+
+        # Nothing is left in the django cache, so any miss would query.
+        cache.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(models.SiteController.get(site_url=site.url), site)
+            self.assertEqual(models.SiteController.auth_url(site_url=site.url), 'identity.foo.com')
+            self.assertEqual(len(models.SiteController.defaults(site_url=site.url)), 1)
+
+    def test_site_saves_invalidate_after_commit(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        version_key = models.SiteController.version_cache_key(site.url)
+        models.SiteController.auth_url(site_url=site.url)
+        version = models.caching.get_version(version_key)
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            site.auth_url = 'identity.bar.com'
+            site.save()
+            # A reader before the commit still sees the old row, so it must
+            # not see the new version either.
+            self.assertEqual(models.caching.get_version(version_key), version)
+
+        for callback in callbacks:
+            callback()
+        self.assertGreater(models.caching.get_version(version_key), version)
+        self.assertEqual(models.SiteController.auth_url(site_url=site.url), 'identity.bar.com')
+
+    def test_changes_from_other_workers_are_seen_after_ttl(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='STRING',
+            key='test-key',
+            deprecated=False,
+            value='test-default',
+        )
+        models.SiteController.defaults(site_url=site.url)
+        expired = time.monotonic() + models.SiteController.local_cache.ttl + 1
+
+        # An unchanged version keeps the entry without loading it again.
+        with mock.patch('pref.store.caching.time.monotonic', return_value=expired):
+            with self.assertNumQueries(0):
+                models.SiteController.defaults(site_url=site.url)
+
+        # Another worker saves the kind, which only reaches us via the cache.
+        models.Kind.objects.filter(site=site).update(value='new-default')
+        cache.delete(models.SiteController.defaults_cache_key(site.url))
+        models.caching.bump_version(models.SiteController.version_cache_key(site.url))
+
+        actual = models.SiteController.default_for_key(site_url=site.url, key='test-key')
+        self.assertEqual(actual.value, 'test-default')
+
+        # The revalidated entry is good for another ttl from `expired`.
+        expired += models.SiteController.local_cache.ttl + 1
+        with mock.patch('pref.store.caching.time.monotonic', return_value=expired):
+            actual = models.SiteController.default_for_key(site_url=site.url, key='test-key')
+        self.assertEqual(actual.value, 'new-default')
+
+    def test_defaults_are_deserialized_once_and_shared(self):
+        site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=site,
+            kind='OBJECT',
+            key='test-key',
+            deprecated=False,
+            value='{"a": [1, 2]}',
+        )
+
+        loads = mock.Mock(wraps=json.loads)
+        object_kind = models.KindController(json.dumps, loads)
+        with mock.patch.dict(models.KINDS, {'OBJECT': object_kind}):
+            actual = models.PreferenceController.get_many(
+                auth_token='fake-token',
+                site_url=site.url,
+                user_ids=['user-1', 'user-2'],
+            )
+
+        self.assertEqual(loads.call_count, 1)
+        first, second = actual['user-1'][0].value, actual['user-2'][0].value
+        self.assertIs(first, second)
+        self.assertEqual(first, {'a': [1, 2]})
+        with self.assertRaises(TypeError):
+            first['a'].append(3)
+
+        # The frozen values survive the trip through the cache.
+        cached = models.PreferenceController.get_many(
+            auth_token='fake-token',
+            site_url=site.url,
+            user_ids=['user-1'],
+        )
+        self.assertEqual(cached['user-1'][0].value, {'a': [1, 2]})
+
+    def test_default_for_key_raises_for_unknown_key(self):
+        models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+
+        with self.assertRaises(models.InvalidKey):
+            models.SiteController.default_for_key(
+                site_url='example.com',
+                key='missing-key',
+            )
@@ -0,0 +1,80 @@
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+
+from pref.store import models, pruning
+
+
+class PruneDeprecatedOverridesTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        models.SiteController.local_cache.clear()
+        self.site = models.Site.objects.create(
+            url='example.com',
+            auth_url='identity.foo.com',
+        )
+        models.Kind.objects.create(
+            site=self.site,
+            kind='STRING',
+            key='test-key',
+            value='test-default',
+        )
+        self.old = models.Kind.objects.create(
+            site=self.site,
+            kind='STRING',
+            key='old-key',
+            deprecated=True,
+            value='old-default',
+        )
+        for key in ('test-key', 'old-key'):
+            models.Override.objects.bulk_create([
+                models.Override(
+                    site=self.site,
+                    user_id=f'user-{user}',
+                    kind='STRING',
+                    key=key,
+                    value='custom',
+                )
+                for user in range(5)
+            ])
+
+    def test_deletes_overrides_of_deprecated_kinds_in_batches(self):
+        sleep = mock.Mock()
+
+        deleted = pruning.prune_deprecated_overrides(batch_size=2, pause=0.5, sleep=sleep)
+
+        self.assertEqual(deleted, 5)
+        self.assertFalse(models.Override.objects.filter(key='old-key').exists())
+        self.assertEqual(models.Override.objects.filter(key='test-key').count(), 5)
+        # Paused after each of the two full batches, the last one was short.
+        self.assertEqual(sleep.call_args_list, [mock.call(0.5), mock.call(0.5)])
+        self.assertEqual(
+            models.Change.objects.filter(key='old-key', action=models.Change.OVERRIDE_RESET).count(),
+            5,
+        )
+
+    def test_stops_after_max_batches(self):
+        deleted = pruning.prune_deprecated_overrides(batch_size=2, max_batches=1, sleep=mock.Mock())
+
+        self.assertEqual(deleted, 2)
+        self.assertEqual(models.Override.objects.filter(key='old-key').count(), 3)
+
+    def test_restored_kinds_are_not_pruned(self):
+        self.old.deprecated = False
+        self.old.save()
+
+        deleted = pruning.prune_batch('example.com', 'old-key')
+
+        self.assertEqual(deleted, 0)
+        self.assertEqual(models.Override.objects.filter(key='old-key').count(), 5)
+
+    def test_command(self):
+        out = StringIO()
+
+        call_command('prune_deprecated_overrides', site='example.com', pause=0, stdout=out)
+
+        self.assertEqual(out.getvalue().strip(), '5 overrides pruned')
@@ -1,19 +1,8 @@
 import json
 
-from graphql import (
-    extend_schema,
-    parse,
-    build_ast_schema,
-    graphql,
-    get_default_backend,
-)
-from graphql.type import (
-    GraphQLField,
-    GraphQLObjectType,
-    GraphQLSchema,
-    GraphQLString,
-)
-from graphql.utils.schema_printer import print_schema
+from graphql import get_default_backend
+
+from july.sdl import build_schema_from_sdl, format_timings
 
 ROOT_QUERY = """
 type Query {
@@ -48,20 +37,11 @@ extend type Query {
 }
 """
 
-root_query = GraphQLObjectType(
-    "Query",
-    {"_empty": GraphQLField(GraphQLString)}
-)
-
-root_schema = GraphQLSchema(
-    query=root_query
-)
-
-
-extenders = extend_schema(root_schema, parse(EXTENDED))
-
-extended_schema = build_ast_schema(parse(print_schema(extenders)))  # repeat as needed
+# Merge the extensions into the root query and build the executable schema
+# in a single pass, rather than extending, printing and parsing it again.
+extended_schema, _document, timings = build_schema_from_sdl([ROOT_QUERY, EXTENDED])
 
+print(format_timings(timings))
 print(dir(extended_schema))
 print(extended_schema.get_type_map())
 
@@ -0,0 +1,137 @@
+import base64
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+# Relay style connections for list fields. Rather than writing the edge and
+# connection types out by hand for every type, `connection_sdl` generates
+# them for the type names listed in `schema.CONNECTION_TYPES`.
+PAGE_INFO_SDL = """
+type PageInfo {
+    hasNextPage: Boolean!
+    endCursor: String
+}
+"""
+
+CONNECTION_SDL = """
+type %(name)sEdge {
+    cursor: String!
+    node: %(name)s
+}
+
+type %(name)sConnection {
+    edges: [%(name)sEdge]
+    pageInfo: PageInfo!
+}
+"""
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+
+def connection_sdl(type_names):
+    sdl = [PAGE_INFO_SDL]
+    for type_name in type_names:
+        sdl.append(CONNECTION_SDL % {'name': type_name})
+    return ''.join(sdl)
+
+
+class Edge(object):
+
+    def __init__(self, node, cursor):
+        self.node = node
+        self.cursor = cursor
+
+
+class PageInfo(object):
+
+    def __init__(self, hasNextPage, endCursor):
+        self.hasNextPage = hasNextPage
+        self.endCursor = endCursor
+
+
+class Connection(object):
+
+    def __init__(self, edges, pageInfo):
+        self.edges = edges
+        self.pageInfo = pageInfo
+
+
+def encode_cursor(values):
+    text = u'\n'.join(cursor_value(value) for value in values)
+    return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        return base64.urlsafe_b64decode(str(cursor)).decode('utf-8').split(u'\n')
+    except (TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+
+def cursor_value(value):
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return u'%s' % value
+
+
+def cursor_fields(queryset, fields, values):
+    """Convert the cursor strings to the python values of the model fields.
+
+    A cursor that does not hold a value of the right type for each field is
+    invalid, rather than an error from the database when it is filtered on.
+    """
+    if len(values) != len(fields):
+        raise ValueError('Invalid cursor')
+    opts = queryset.model._meta
+    try:
+        return [
+            (opts.pk if field == 'pk' else opts.get_field(field)).to_python(value)
+            for field, value in zip(fields, values)
+        ]
+    except (ValidationError, TypeError, ValueError):
+        raise ValueError('Invalid cursor')
+
+
+def page_size(first):
+    if first is None:
+        return DEFAULT_PAGE_SIZE
+    if first < 0:
+        raise ValueError('first must not be negative')
+    return min(first, MAX_PAGE_SIZE)
+
+
+def keyset_filter(fields, values):
+    """Rows that sort after the cursor values, for a descending ordering.
+
+    For fields (a, b) that is `a < x OR (a = x AND b < y)` which the database
+    can answer from the index without counting the rows it skips over.
+    """
+    condition = Q()
+    for position, field in enumerate(fields):
+        lookup = dict(zip(fields[:position], values[:position]))
+        lookup[field + '__lt'] = values[position]
+        condition |= Q(**lookup)
+    return condition
+
+
+def keyset_connection(queryset, first=None, after=None, fields=('pk',)):
+    """Return a page of the queryset as a Connection.
+
+    The queryset is ordered descending by `fields`, the last field must be
+    unique so every row has a distinct cursor. Only `first + 1` rows are ever
+    fetched no matter how deep the page is.
+    """
+    size = page_size(first)
+    queryset = queryset.order_by(*['-' + field for field in fields])
+    if after is not None:
+        values = cursor_fields(queryset, fields, decode_cursor(after))
+        queryset = queryset.filter(keyset_filter(fields, values))
+
+    rows = list(queryset[:size + 1])
+    edges = [
+        Edge(row, encode_cursor([getattr(row, field) for field in fields]))
+        for row in rows[:size]
+    ]
+    end_cursor = edges[-1].cursor if edges else None
+    return Connection(edges, PageInfo(len(rows) > size, end_cursor))
@@ -0,0 +1,108 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import partial
+
+from graphql import parse
+from graphql.backend.base import GraphQLDocument
+from graphql.execution import ExecutionResult, execute
+from graphql.validation import validate
+
+
+class DocumentCache(object):
+    """Bounded LRU cache of parsed and validated query documents.
+
+    Clients send the same handful of queries over and over again, so there
+    is no reason to lex, parse and validate them on every request. The cache
+    is keyed by the schema identity and a hash of the query text, and stores
+    a `GraphQLDocument` that executes without validating again.
+    """
+
+    def __init__(self, size=500):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._documents = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __contains__(self, key):
+        return key in self._documents
+
+    @staticmethod
+    def cache_key(schema, query):
+        digest = hashlib.sha256(query.encode('utf-8')).hexdigest()
+        return (id(schema), digest)
+
+    def document_from_string(self, schema, query):
+        key = self.cache_key(schema, query)
+        document = self.get(key)
+        if document is not None:
+            return document
+
+        document, valid = compile_document(schema, query)
+
+        # Only cache documents that passed validation, otherwise a client
+        # sending garbage could push all the good queries out of the cache.
+        if valid:
+            self.add(key, document)
+        return document
+
+    def get(self, key):
+        """The document stored under `key`, or None."""
+        with self._lock:
+            document = self._documents.pop(key, None)
+            if document is None:
+                self.misses += 1
+                return None
+            # Re-insert the document so it is the most recently used.
+            self._documents[key] = document
+            self.hits += 1
+            return document
+
+    def add(self, key, document):
+        """Store a validated document, evicting the least recently used."""
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._documents.pop(key, None)
+            self._documents[key] = document
+            while len(self._documents) > self.size:
+                self._documents.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._documents.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._documents),
+            'max_size': self.size,
+        }
+
+
+def compile_document(schema, query):
+    """Parse and validate the query returning a (document, valid) tuple.
+
+    Parse errors are raised just like `backend.document_from_string` would.
+    Validation errors are returned from `document.execute` the same way the
+    default backend does it, so the view does not need to know the difference.
+    """
+    document_ast = parse(query)
+    errors = validate(schema, document_ast)
+    if errors:
+        def execute_invalid(*args, **kwargs):
+            return ExecutionResult(errors=errors, invalid=True)
+
+        return GraphQLDocument(schema, query, document_ast, execute_invalid), False
+
+    # The document has already been validated so skip that on execute.
+    execute_valid = partial(execute, schema, document_ast)
+    return GraphQLDocument(schema, query, document_ast, execute_valid), True
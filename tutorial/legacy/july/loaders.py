@@ -0,0 +1,58 @@
+from promise import Promise
+from promise.dataloader import DataLoader
+
+from july.models import Commit, Game
+
+
+class CommitLoader(DataLoader):
+    """Load the commits for many calendars with a single query per game.
+
+    Keys are `(game_id, username)` tuples where a username of None means the
+    commits for every user. All the calendars requested while resolving a
+    query are batched together, and repeated keys are memoized for the rest
+    of the request.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(CommitLoader, self).__init__(*args, **kwargs)
+        self.batches = 0
+        self.keys_loaded = 0
+
+    def batch_load_fn(self, keys):
+        self.batches += 1
+        self.keys_loaded += len(keys)
+
+        usernames_by_game = {}
+        for game_id, username in keys:
+            usernames_by_game.setdefault(game_id, set()).add(username)
+
+        games = Game.objects.in_bulk(list(usernames_by_game))
+        commits = {}
+        for game_id, usernames in usernames_by_game.items():
+            query = Commit.calendar(game=games[game_id]).select_related('user')
+            # If any calendar wants every commit for the game we fetch them
+            # all and split them up, otherwise just the requested users.
+            if None not in usernames:
+                query = query.filter(user__username__in=usernames)
+            for commit in query:
+                commits.setdefault((game_id, None), []).append(commit)
+                if commit.user is not None:
+                    user_key = (game_id, commit.user.username)
+                    commits.setdefault(user_key, []).append(commit)
+
+        return Promise.resolve([commits.get(key, []) for key in keys])
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'keys_loaded': self.keys_loaded,
+            'cached_keys': len(self._promise_cache),
+        }
+
+
+def commit_loader(context):
+    """Return the commit loader for this request, the context is the request."""
+    loader = getattr(context, 'commit_loader', None)
+    if loader is None:
+        loader = context.commit_loader = CommitLoader()
+    return loader
@@ -0,0 +1,96 @@
+import hashlib
+import os
+
+from documents import DocumentCache, compile_document
+
+
+class PersistedQueryNotFound(Exception):
+    pass
+
+
+class PersistedQueryMismatch(Exception):
+    pass
+
+
+def query_id_for(query):
+    """The id of a persisted query is the sha256 of the query text."""
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+class PersistedQueryRegistry(object):
+    """Pre-compiled documents that clients can refer to by id.
+
+    Instead of sending the full query text on every request clients send the
+    sha256 hash of the query. The documents are parsed and validated once when
+    they are registered so executing one is just a dictionary lookup.
+
+    By default only the queries loaded at startup are registered, an unknown
+    id sent along with the full query text just runs that query. If
+    `auto_register` is turned on the query is also added to the registry so
+    the next request can send the id alone. Clients choose those queries, so
+    at most `size` of them are kept in an LRU while the queries loaded at
+    startup are never evicted.
+    """
+
+    def __init__(self, auto_register=False, size=500):
+        self.auto_register = auto_register
+        self._documents = {}
+        self._registered = DocumentCache(size=size)
+
+    def __len__(self):
+        return len(self._documents) + len(self._registered)
+
+    def __contains__(self, query_id):
+        return query_id in self._documents or query_id in self._registered
+
+    def load(self, schema, directory):
+        """Register every `.graphql` file found in the directory."""
+        for filename in sorted(os.listdir(directory)):
+            if not filename.endswith('.graphql'):
+                continue
+            with open(os.path.join(directory, filename)) as query_file:
+                query = query_file.read().strip()
+            document, valid = compile_document(schema, query)
+            if not valid:
+                raise ValueError(
+                    'Persisted query %s is not valid for the schema' % filename)
+            self._documents[query_id_for(query)] = document
+
+    def register(self, schema, query, query_id=None):
+        """Compile and store the query, returning the document."""
+        actual_id = query_id_for(query)
+        if query_id is not None and query_id != actual_id:
+            raise PersistedQueryMismatch(query_id)
+
+        document, valid = compile_document(schema, query)
+        if valid:
+            self._registered.add(actual_id, document)
+        return document
+
+    def document_for_id(self, schema, query_id, query=None, document_cache=None):
+        """Lookup the document for the query id.
+
+        When an unknown id is sent along with the query text the query is
+        executed as a regular one, parsed through the `document_cache` if
+        given. It is only added to the registry when automatic registration
+        is enabled, so clients that retry with the full text never loop on
+        `PersistedQueryNotFound`.
+        """
+        document = self._documents.get(query_id)
+        if document is None:
+            document = self._registered.get(query_id)
+        if document is not None:
+            return document
+
+        if query is None:
+            raise PersistedQueryNotFound(query_id)
+
+        if self.auto_register:
+            return self.register(schema, query, query_id=query_id)
+
+        if query_id != query_id_for(query):
+            raise PersistedQueryMismatch(query_id)
+        if document_cache is not None:
+            return document_cache.document_from_string(schema, query)
+        document, _valid = compile_document(schema, query)
+        return document
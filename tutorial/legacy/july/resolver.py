@@ -1,3 +1,6 @@
+import inspect
+
+from graphql.type import GraphQLObjectType
 
 from resources.commit import calendar
 
@@ -8,6 +11,12 @@ resource_registry = {
     }
 }
 
+# The python classes backing our schema types, used by `bind_resolvers` to
+# find out which fields are methods rather than attributes.
+resource_classes = {
+    "CommitCalendar": calendar.CommitCalendar,
+}
+
 
 def resolver_func(resource, info, **kwargs):
     global resource_registry
@@ -32,6 +41,47 @@ def resolver_func(resource, info, **kwargs):
         return getattr(resource, field_name, None)
 
 
+def attribute_resolver(field_name):
+    # Plain attributes (or properties) of the resource, this is what the
+    # fallback in `resolver_func` does but without the registry lookup.
+    def resolve_attribute(resource, info, **kwargs):
+        return getattr(resource, field_name, None)
+    return resolve_attribute
+
+
+def method_resolver(field_name):
+    # Methods on the resource are called with the info and field arguments
+    # the same way as the functions in the resource_registry.
+    def resolve_method(resource, info, **kwargs):
+        return getattr(resource, field_name)(info, **kwargs)
+    return resolve_method
+
+
+def bind_resolvers(schema, registry, classes=None):
+    """Attach a resolver to every field of every object type in the schema.
+
+    Walking the schema once at startup means resolving a field is a single
+    function call, rather than a registry lookup with a `KeyError` for every
+    plain attribute. The optional `classes` mapping of type name to python
+    class is used to tell methods apart from attributes up front.
+    """
+    classes = classes or {}
+    for type_name, type_obj in schema.get_type_map().items():
+        if type_name.startswith('__') or not isinstance(type_obj, GraphQLObjectType):
+            continue
+        custom_resolvers = registry.get(type_name, {})
+        resource_class = classes.get(type_name)
+        for field_name, field in type_obj.fields.items():
+            if field_name in custom_resolvers:
+                resolve_func = custom_resolvers[field_name]
+                field.resolver = resolve_func
+                field.description = resolve_func.__doc__
+            elif inspect.isroutine(getattr(resource_class, field_name, None)):
+                field.resolver = method_resolver(field_name)
+            else:
+                field.resolver = attribute_resolver(field_name)
+
+
 def legacy_middleware(next, *args, **kwargs):
     # We need to handle the old interface to graphql resolution. In the
     # graphql-core-next version we can directly specify the resolver function.
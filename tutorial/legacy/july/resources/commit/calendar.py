@@ -1,5 +1,6 @@
-from july.models import Commit
-from july.models import Game
+from july.connection import keyset_connection
+from july.loaders import commit_loader
+from july.models import Commit, Game
 
 
 class CommitCalendar:
@@ -10,19 +11,28 @@ class CommitCalendar:
     def __init__(self, username=None):
         # TODO: check info.context for the correct user permissions?
         self.game = Game.active_or_latest()
-        self.filters = {}
-        if username is not None:
-            self.filters['user__username'] = username
+        self.username = username
 
         self.start = self.game.start
         self.end = self.game.end
 
-    @property
-    def commits(self):
+    def commits(self, info):
         # None -> [Commit]
-        # Allow for lazy loading
-        print('I am in commits')
-        return Commit.calendar(game=self.game, **self.filters)
+        # Allow for lazy loading, the loader batches the commit queries for
+        # every calendar in the request into one query per game.
+        loader = commit_loader(info.context)
+        return loader.load((self.game.pk, self.username))
+
+    def commitsConnection(self, info, first=None, after=None):
+        # CommitConnection, a page of commits newest first. Paging uses the
+        # (timestamp, hash) of the last commit seen rather than an offset so
+        # deep pages cost the same as the first one.
+        filters = {}
+        if self.username is not None:
+            filters['user__username'] = self.username
+        query = Commit.calendar(game=self.game, **filters)
+        return keyset_connection(
+            query, first=first, after=after, fields=('timestamp', 'hash'))
 
 
 def getCommitCalendar(source, info, username=None):
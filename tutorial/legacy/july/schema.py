@@ -1,50 +1,135 @@
+import hashlib
 import os
+import tempfile
+from timeit import default_timer
 
-from graphql import build_ast_schema, extend_schema, parse, print_schema
-from graphql.type import (
-    GraphQLArgument,
-    GraphQLEnumType,
-    GraphQLEnumValue,
-    GraphQLField,
-    GraphQLInterfaceType,
-    GraphQLList,
-    GraphQLNonNull,
-    GraphQLObjectType,
-    GraphQLSchema,
-    GraphQLString,
-)
+import graphql
+from graphql.error import GraphQLError
+from graphql.language.printer import print_ast
+
+from july.connection import connection_sdl
+from july.sdl import build_schema_from_sdl, format_timings
 
 # We need to have a root query that we can extend, according to th SDL spec
 # we can not have an empty query type. So we initialize it with `_empty` which
-# will never get used.
-root_query = GraphQLObjectType(
-    "Query",
-    {"_empty": GraphQLField(GraphQLString)}
-)
+# will never get used. The older graphql-core also requires an explicit
+# schema definition to build an executable schema.
+ROOT_QUERY = """
+type Query {
+  _empty: String
+}
 
-# In order to extend the schema we need to start with a valid schema
-# class instance. In graphql-core-next we can use a SDL file for the root
-# as well. Here we need a little hack to future proof the rest of our
-# application structure.
-root_schema = GraphQLSchema(
-    query=root_query
-)
+schema {
+  query: Query
+}
+"""
+
+# Types that get a generated `<Type>Connection` and `<Type>Edge` for paging.
+CONNECTION_TYPES = ['Commit']
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-schema_files = os.listdir(os.path.join(BASE_DIR, 'gql'))
-schema_files.sort()
+GQL_DIR = os.path.join(BASE_DIR, 'gql')
+
+# Merged schema documents are written here as SDL so that new workers parse
+# one file instead of merging every SDL file. The artifact is only ever
+# parsed, so a shared directory can not be used to run code on boot. Bump
+# the version if the artifact format changes.
+SCHEMA_CACHE_DIR = os.environ.get(
+    'JULY_SCHEMA_CACHE_DIR',
+    os.path.join(os.path.dirname(BASE_DIR), '.schema_cache'),
+)
+SCHEMA_CACHE_VERSION = '2'
+
+
+def read_schema_files(directory):
+    sources = []
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.graphql'):
+            continue
+        with open(os.path.join(directory, filename)) as schema_file:
+            sources.append(schema_file.read())
+    return sources
+
+
+def schema_fingerprint(sources):
+    """A hash of the SDL content, any change to the files changes this."""
+    fingerprint = hashlib.sha256()
+    fingerprint.update(SCHEMA_CACHE_VERSION.encode('utf-8'))
+    fingerprint.update(graphql.__version__.encode('utf-8'))
+    for source in sources:
+        source_hash = hashlib.sha256(source.encode('utf-8')).hexdigest()
+        fingerprint.update(source_hash.encode('utf-8'))
+    return fingerprint.hexdigest()
+
+
+def read_cached_document(cache_dir, fingerprint):
+    path = os.path.join(cache_dir, 'schema-%s.graphql' % fingerprint)
+    try:
+        with open(path, 'rb') as cache_file:
+            return graphql.parse(cache_file.read().decode('utf-8'), no_location=True)
+    except (IOError, OSError, ValueError, GraphQLError):
+        # Missing or unreadable artifacts just mean we build from scratch.
+        return None
+
+
+def write_cached_document(cache_dir, fingerprint, document):
+    filename = 'schema-%s.graphql' % fingerprint
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to a temp file and rename it into place, so other workers
+        # booting at the same time never read a partially written file.
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        sdl = print_ast(document)
+        if not isinstance(sdl, bytes):
+            sdl = sdl.encode('utf-8')
+        with os.fdopen(fd, 'wb') as cache_file:
+            cache_file.write(sdl)
+        os.rename(tmp_path, os.path.join(cache_dir, filename))
+
+        # Clean up artifacts for older versions of the schema files.
+        for stale in os.listdir(cache_dir):
+            if stale.startswith('schema-') and stale != filename:
+                os.remove(os.path.join(cache_dir, stale))
+    except (IOError, OSError):
+        # The cache is only an optimization, a read only filesystem should
+        # not stop the application from starting.
+        pass
+
+
+def load_schema(directory=GQL_DIR, cache_dir=SCHEMA_CACHE_DIR):
+    """Load the root query, connections and every `.graphql` file in the directory.
+
+    If `cache_dir` is set the merged document is printed to disk keyed by
+    the fingerprint of the SDL files. The next worker to boot parses that
+    one file and skips merging the others.
+    """
+    start = default_timer()
+    sources = [ROOT_QUERY, connection_sdl(CONNECTION_TYPES)]
+    sources.extend(read_schema_files(directory))
+    read_time = default_timer() - start
+
+    document = None
+    fingerprint = None
+    if cache_dir:
+        fingerprint = schema_fingerprint(sources)
+        document = read_cached_document(cache_dir, fingerprint)
+    cache_hit = document is not None
+
+    schema, document, timings = build_schema_from_sdl(sources, document)
+    if cache_dir and not cache_hit:
+        write_cached_document(cache_dir, fingerprint, document)
+
+    timings['read'] = read_time
+    timings['cache'] = 'hit' if cache_hit else 'miss'
+    timings['total'] = default_timer() - start
+    return schema, timings
+
 
-for filename in schema_files:
-    with open(os.path.join(BASE_DIR, 'gql', filename)) as schema_file:
-        schema_data = schema_file.read()
-        # Each time we extend the root schema it makes a copy and returns
-        # the newly extended schema and the orginal is unchanged.
-        root_schema = extend_schema(root_schema, parse(schema_data))
+schema, schema_timings = load_schema()
 
 
-# Since extend_schema parses client schema you'll get an error if you attempt
-# to execute it: 'Client Schema cannot be used for execution.'
-# Printing out the full schema and then parsing it avoids this issue.
-fully_extended_schema_sdl = print_schema(root_schema)
-schema = build_ast_schema(parse(fully_extended_schema_sdl))
+if __name__ == '__main__':
+    # Run `python july/schema.py` to see how long the schema takes to build.
+    print(format_timings(schema_timings))
@@ -27,3 +27,14 @@ ROOT_URLCONF = 'july.urls'
 
 STATIC_URL = '/static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static_root')
+
+# Maximum number of parsed query documents to keep in memory per process.
+GRAPHQL_DOCUMENT_CACHE_SIZE = 500
+
+# Allow clients to register new persisted queries by sending the full text
+# along with the query id. Otherwise only the files in `july/queries` work.
+GRAPHQL_PERSISTED_QUERIES_AUTO_REGISTER = False
+
+# Maximum number of automatically registered persisted queries to keep in
+# memory per process, the least recently used are dropped first.
+GRAPHQL_PERSISTED_QUERIES_MAX_REGISTERED = 500
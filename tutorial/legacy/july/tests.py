@@ -0,0 +1,67 @@
+import base64
+import datetime
+
+from django.test import TestCase
+
+from july.connection import encode_cursor, keyset_connection
+from july.models import Commit
+
+
+class KeysetConnectionTest(TestCase):
+
+    def setUp(self):
+        noon = datetime.datetime(2018, 7, 10, 12, 0, 0)
+        # Several commits share a timestamp, so the hash has to break the
+        # tie for the cursor to land between them.
+        timestamps = [noon, noon, noon, noon - datetime.timedelta(hours=1), noon, noon]
+        for number, timestamp in enumerate(timestamps):
+            Commit.objects.create(hash='hash-%d' % number, timestamp=timestamp)
+
+    def page(self, first=None, after=None):
+        return keyset_connection(
+            Commit.objects.all(), first=first, after=after, fields=('timestamp', 'hash'))
+
+    def hashes(self, connection):
+        return [edge.node.hash for edge in connection.edges]
+
+    def test_pages_across_equal_timestamps(self):
+        pages = []
+        after = None
+        while True:
+            connection = self.page(first=2, after=after)
+            pages.append(self.hashes(connection))
+            if not connection.pageInfo.hasNextPage:
+                break
+            after = connection.pageInfo.endCursor
+
+        self.assertEqual(pages, [
+            ['hash-5', 'hash-4'],
+            ['hash-2', 'hash-1'],
+            ['hash-0', 'hash-3'],
+        ])
+
+    def test_last_page_has_no_next_page(self):
+        connection = self.page(first=6)
+
+        self.assertEqual(len(connection.edges), 6)
+        self.assertFalse(connection.pageInfo.hasNextPage)
+
+    def test_after_the_last_row_is_an_empty_page(self):
+        last = self.page(first=6).pageInfo.endCursor
+
+        connection = self.page(first=2, after=last)
+
+        self.assertEqual(connection.edges, [])
+        self.assertEqual(connection.pageInfo.endCursor, None)
+        self.assertFalse(connection.pageInfo.hasNextPage)
+
+    def test_bad_cursors_are_rejected(self):
+        for after in (
+            'not base64!',
+            encode_cursor(['2018-07-10T12:00:00']),
+            encode_cursor(['2018-07-10T12:00:00', 'hash-1', 'extra']),
+            encode_cursor(['yesterday', 'hash-1']),
+            base64.urlsafe_b64encode(b'\xff\xfe').decode('ascii'),
+        ):
+            with self.assertRaises(ValueError):
+                self.page(after=after)
@@ -1,13 +1,34 @@
 import json
+import os
 
 from django import http
+from django.conf import settings
 from django.middleware.csrf import get_token
 from django.shortcuts import render_to_response
 from django.template import Context
-from graphql import get_default_backend
 
-from resolver import resource_registry
-from schema import schema
+from documents import DocumentCache
+from persisted import (
+    PersistedQueryMismatch,
+    PersistedQueryNotFound,
+    PersistedQueryRegistry,
+)
+from resolver import bind_resolvers, resource_classes, resource_registry
+from schema import BASE_DIR, schema
+
+# Parsed and validated documents keyed by the query text, clients only send
+# a few hundred distinct queries so steady state requests skip the parser.
+document_cache = DocumentCache(
+    size=getattr(settings, 'GRAPHQL_DOCUMENT_CACHE_SIZE', 500),
+)
+
+# Queries that clients can execute by sending the sha256 id of the query
+# rather than the full text. These are loaded and compiled once at startup.
+persisted_queries = PersistedQueryRegistry(
+    auto_register=getattr(settings, 'GRAPHQL_PERSISTED_QUERIES_AUTO_REGISTER', False),
+    size=getattr(settings, 'GRAPHQL_PERSISTED_QUERIES_MAX_REGISTERED', 500),
+)
+persisted_queries.load(schema, os.path.join(BASE_DIR, 'queries'))
 
 
 def get_graphql_params(request, data):
@@ -21,10 +42,25 @@ def get_graphql_params(request, data):
     return query, variables, operation_name
 
 
+def get_persisted_query_id(request, data):
+    # Support both a plain `id` param and the apollo style extension:
+    # {"extensions": {"persistedQuery": {"version": 1, "sha256Hash": "..."}}}
+    query_id = request.GET.get("id") or data.get("id")
+    if query_id is None:
+        extensions = data.get("extensions") or {}
+        persisted_query = extensions.get("persistedQuery") or {}
+        query_id = persisted_query.get("sha256Hash")
+    return query_id
+
+
 def execute_graphql_request(request, data, query, variables, operation_name):
-    backend = get_default_backend()
+    query_id = get_persisted_query_id(request, data)
     try:
-        document = backend.document_from_string(schema, query)
+        if query_id is not None:
+            document = persisted_queries.document_for_id(
+                schema, query_id, query, document_cache=document_cache)
+        else:
+            document = document_cache.document_from_string(schema, query)
     except Exception:
         raise
 
@@ -39,16 +75,9 @@ def execute_graphql_request(request, data, query, variables, operation_name):
         raise
 
 
-for _type, resolvers in resource_registry.iteritems():
-    type_obj = schema.get_type(_type)
-    if type_obj is None:
-        continue
-    for field_name, resolve_func in resolvers.iteritems():
-        field = type_obj.fields.get(field_name)
-        if field is None:
-            continue
-        field.resolver = resolve_func
-        field.description = resolve_func.__doc__
+# Attach the resolvers to the schema once, so that resolving a field is a
+# direct function call rather than a lookup in the registry.
+bind_resolvers(schema, resource_registry, classes=resource_classes)
 
 
 def graph(request):
@@ -76,7 +105,14 @@ def graph(request):
 
         # execute the query against our schema and resolvers
         query, variables, operation_name = get_graphql_params(request, data)
-        results = execute_graphql_request(request, data, query, variables, operation_name)
+        try:
+            results = execute_graphql_request(request, data, query, variables, operation_name)
+        except PersistedQueryNotFound:
+            # Let the client know it needs to send the full query text.
+            content = json.dumps({'errors': [{'message': 'PersistedQueryNotFound'}]})
+            return http.HttpResponse(content, content_type='application/json')
+        except PersistedQueryMismatch:
+            return http.HttpResponseBadRequest('Query does not match the persisted query id')
         content = json.dumps(results.to_dict())
         print(content)
         return http.HttpResponse(content, content_type='application/json')